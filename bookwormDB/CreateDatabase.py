@@ -10,7 +10,6 @@ from variableSet import splitMySQLcode
 from bookwormDB.configuration import Configfile
 import logging
 import warnings
-import anydbm
 
 
 
@@ -30,21 +29,11 @@ def text_id_dbm():
     """
     This quickly creates a key-value store for textids: storing on disk
     dramatically reduces memory consumption for bookworms of over 
-    1 million documents.
+    1 million documents. It's written in one pass as a memory-mapped
+    table at .bookworm/texts/textids.idx.
     """
-    dbm = anydbm.open(".bookworm/texts/textids.dbm","c")
-    for file in os.listdir(".bookworm/texts/textids"):
-        for line in open(".bookworm/texts/textids/" + file):
-            line = line.rstrip("\n")
-            splat = line.split("\t")
-            try:
-                dbm[splat[1]] = splat[0]
-            except IndexError:
-                if line=="":
-                    # It's OK to have a blank line, let's say.
-                    continue
-                else:
-                    raise
+    from bookwormDB.tokenizer import writeIDTable
+    writeIDTable()
 
 class DB:
     def __init__(self,dbname=None):
@@ -137,6 +126,368 @@ class DB:
                     raise
         return cursor
 
+def count_table_names(tablenameroot, table_count):
+    """
+    If you are splitting the input into multiple tables to be joined as a
+    merge table, come up with multiple table names to cycle through.
+    """
+    if table_count == 1:
+        return [tablenameroot]
+    elif table_count > 1:
+        return ["%s_p%d" % (tablenameroot, i) for i in range(1, table_count+1)]
+    else:
+        logging.error("You need a positive integer for table_count")
+        raise ValueError("table_count must be a positive integer")
+
+def wordid_partition_sql(column, partitions, table_count=1):
+    """
+    The PARTITION BY clause for a count table split into `partitions` ranges
+    of the word id in `column`, or nothing if it isn't partitioned.
+    """
+    if partitions <= 1:
+        return ""
+    if table_count > 1:
+        raise ValueError("Use either table_count or wordid_partitions, not both")
+    bounds = wordid_partition_bounds(partitions)
+    return (" PARTITION BY RANGE (" + column + ") (" +
+            ", ".join(["PARTITION p%d VALUES LESS THAN (%d)" % (i, bound) for (i, bound) in enumerate(bounds)] +
+                      ["PARTITION p%d VALUES LESS THAN MAXVALUE" % len(bounds)]) + ")")
+
+def count_file_assignments(grampath, tablenames):
+    """
+    Deal the encoded files in `grampath` out across `tablenames`, as
+    `load_count_files` takes them: text and packed files go round the
+    tables in turn, and every table takes its own share of the chunks of an
+    HDF5 store, since a single store can be huge.
+    """
+    assignments = dict((tablename, []) for tablename in tablenames)
+    for i, filename in enumerate(sorted(os.listdir(grampath))):
+        if filename.endswith('.txt') or filename.endswith('.bin'):
+            assignments[tablenames[i % len(tablenames)]].append(grampath + "/" + filename)
+        elif filename.endswith('.h5'):
+            for j, tablename in enumerate(tablenames):
+                assignments[tablename].append((grampath + "/" + filename, j, len(tablenames)))
+    return assignments
+
+def wordid_partition_bounds(partitions, wordlist=".bookworm/texts/wordlist/wordlist.txt"):
+    """
+    Upper bounds for `partitions` ranges of wordid, from the counts in the
+    wordlist: each range covers about the same number of word occurrences,
+    so the common words at the low ids get narrow ranges to themselves.
+    Returns one bound fewer than the number of partitions; the last range is
+    open-ended, for ids added later.
+    """
+    counts = []
+    for line in open(wordlist):
+        (wordid, word, count) = line.rstrip("\n").split("\t")
+        counts.append((int(wordid), int(count)))
+    counts.sort()
+    total = sum(count for (wordid, count) in counts)
+    bounds = []
+    seen = 0
+    for (wordid, count) in counts:
+        seen += count
+        # Close a range once it has its share, starting the next at the next id.
+        if len(bounds) < partitions - 1 and seen >= total * (len(bounds) + 1) / float(partitions):
+            if len(bounds) == 0 or wordid + 1 > bounds[-1]:
+                bounds.append(wordid + 1)
+    return bounds
+
+def insert_statements_from_text(lines, tablename, columns, batchRows=5000):
+    """
+    Multi-row INSERT statements of up to `batchRows` rows each for the lines
+    of a tab-separated count file, read as they are needed.
+
+    The counts are all integers, so a batch of lines that are nothing but
+    tab-separated runs of digits, with the right number of fields, goes in as
+    it is; anything else (an empty field, say) is checked a line at a time,
+    and bad lines are skipped.
+    """
+    import itertools
+    head = "INSERT INTO " + tablename + " (" + ",".join(columns) + ") VALUES "
+    clean = re.compile(r"\A\d+(?:\t\d+)*(?:\n\d+(?:\t\d+)*)*\Z")
+    lines = iter(lines)
+    while True:
+        batch = [line.rstrip("\n") for line in itertools.islice(lines, batchRows)]
+        if len(batch) == 0:
+            break
+        batch = [line for line in batch if line != ""]
+        if len(batch) == 0:
+            continue
+        text = "\n".join(batch)
+        if clean.match(text) is None or text.count("\t") != len(batch) * (len(columns) - 1):
+            checked = []
+            for line in batch:
+                fields = line.split("\t")
+                try:
+                    if len(fields) != len(columns):
+                        raise ValueError(line)
+                    checked.append("\t".join([str(int(field)) for field in fields]))
+                except ValueError:
+                    logging.warning("Skipping a malformed count line: %r" % line[:100])
+            if len(checked) == 0:
+                continue
+            batch = checked
+            text = "\n".join(batch)
+        yield (len(batch), head + "(" + text.replace("\t", ",").replace("\n", "),(") + ")")
+
+def insert_statements_from_records(chunks, tablename, columns, batchRows=5000):
+    """
+    Multi-row INSERT statements for (n, width) arrays of integer records, as
+    from `packedCounts.readRecords`.
+    """
+    head = "INSERT INTO " + tablename + " (" + ",".join(columns) + ") VALUES "
+    row = "(" + ",".join(["%d"] * len(columns)) + "),"
+    for records in chunks:
+        for start in xrange(0, len(records), batchRows):
+            batch = records[start:start + batchRows]
+            yield (len(batch), head + ((row * len(batch)) % tuple(batch.ravel().tolist()))[:-1])
+
+_checksums = dict()
+
+def file_checksum(path, blockSize=4*1024*1024):
+    """
+    The md5 of a file, read a block at a time. It is remembered until the
+    file's size or modification time changes, so the parts of one `.h5`
+    don't each read the whole file again.
+    """
+    import hashlib
+    key = (path, os.path.getsize(path), os.path.getmtime(path))
+    if key in _checksums:
+        return _checksums[key]
+    digest = hashlib.md5()
+    input = open(path, "rb")
+    try:
+        for block in iter(lambda: input.read(blockSize), ""):
+            digest.update(block)
+    finally:
+        input.close()
+    _checksums[key] = digest.hexdigest()
+    return _checksums[key]
+
+def memory_code_checksum(code):
+    """
+    The md5 of the stored code for a memory table.
+    """
+    import hashlib
+    if isinstance(code, unicode):
+        code = code.encode("utf-8")
+    return hashlib.md5(code).hexdigest()
+
+def memory_table_order(parents):
+    """
+    The memory tables in `parents` (a dict of each table's `dependsOn`),
+    ordered so that each comes after its parent when that is also in the
+    dict. Parents outside the dict, a table's dependence on itself, and any
+    cycle are dropped from `parents` in place, so a table left with a parent
+    of None can start straight away.
+    """
+    for tablename in parents:
+        if parents[tablename] not in parents or parents[tablename] == tablename:
+            parents[tablename] = None
+    order = []
+    placed = set()
+    for tablename in sorted(parents):
+        while tablename not in placed:
+            chain = []
+            current = tablename
+            while current is not None and current not in placed and current not in chain:
+                chain.append(current)
+                current = parents[current]
+            if current is not None and current in chain:
+                logging.warning("Memory tables %s depend on each other: reloading them in any order" % ", ".join(chain[chain.index(current):]))
+                parents[current] = None
+                continue
+            for link in reversed(chain):
+                order.append(link)
+                placed.add(link)
+    return order
+
+def h5_records(path, key, width, chunkRows=2000000, part=0, parts=1):
+    """
+    Yield the counts in table `key` of an HDF5 store as (n, width) integer
+    arrays of up to `chunkRows` rows, with the index columns first.
+    Only every `parts`th chunk is read, starting from number `part`.
+
+    This needs pandas (and PyTables) but not dask. A store written in the
+    'fixed' rather than 'table' format can't be read in pieces, so it is read
+    whole, by part 0 alone.
+    """
+    import pandas as pd
+    store = pd.HDFStore(path, mode="r")
+    try:
+        storer = store.get_storer(key)
+        if storer.is_table:
+            nrows = storer.nrows
+            frames = (store.select(key, start=start, stop=min(start + chunkRows, nrows))
+                      for start in xrange(part * chunkRows, nrows, parts * chunkRows))
+        elif part == 0:
+            logging.warning("%s isn't in table format, so it has to be read in one piece" % path)
+            frames = [store.select(key)]
+        else:
+            frames = []
+        for frame in frames:
+            if any(name is not None for name in frame.index.names):
+                frame = frame.reset_index()
+            records = frame.values
+            if records.shape[1] != width:
+                raise ValueError("%s/%s has %d columns, not %d" % (path, key, records.shape[1], width))
+            yield records.astype("int64")
+    finally:
+        store.close()
+
+def count_file_bookids(path, part=0, parts=1):
+    """
+    The set of bookids with counts in an encoded unigram file: tab-separated,
+    packed, or (every `parts`th chunk from `part` of) an HDF5 store.
+    """
+    from bookwormDB.packedCounts import readRecords, SUFFIX
+    import numpy as np
+    bookids = set()
+    if path.endswith(SUFFIX):
+        chunks = readRecords(path, 3)
+    elif path.endswith(".h5"):
+        chunks = h5_records(path, "unigrams", 3, part=part, parts=parts)
+    else:
+        input = open(path)
+        try:
+            for line in input:
+                bookid = line.split("\t", 1)[0]
+                if bookid.isdigit():
+                    bookids.add(int(bookid))
+        finally:
+            input.close()
+        return bookids
+    for records in chunks:
+        bookids.update(np.unique(records[:, 0]).tolist())
+    return bookids
+
+def bulk_insert(db, statements, depth=4):
+    """
+    Execute (rows, statement) pairs over `db`'s connection, for servers that
+    don't allow LOAD DATA LOCAL INFILE. A background thread sends each
+    statement while the next ones are formatted, with at most `depth`
+    waiting. Returns the number of rows inserted.
+    """
+    import threading
+    import Queue
+    if db.conn is None:
+        db.connect()
+    queue = Queue.Queue(depth)
+    result = dict(rows=0, error=None)
+
+    def send():
+        cursor = db.conn.cursor()
+        for (rows, statement) in iter(queue.get, None):
+            if result["error"] is not None:
+                continue
+            try:
+                cursor.execute(statement)
+                result["rows"] += rows
+            except Exception, e:
+                result["error"] = e
+
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+    try:
+        for item in statements:
+            if result["error"] is not None:
+                break
+            queue.put(item)
+    finally:
+        queue.put(None)
+        thread.join()
+    if result["error"] is not None:
+        raise result["error"]
+    db.conn.commit()
+    return result["rows"]
+
+class pipeLoader(object):
+    """
+    A `LOAD DATA LOCAL INFILE` into `tablename` from the named pipe at
+    `path`, run over its own connection in a background thread, so that
+    whatever is written to the pipe goes straight into MySQL.
+    """
+
+    def __init__(self, dbname, path, tablename, columns):
+        import threading
+        import time
+        self.dbname = dbname
+        self.path = path
+        self.tablename = tablename
+        self.columns = columns
+        self.rows = 0
+        self.error = None
+        self.opened = False
+        self.start = time.time()
+        self.thread = threading.Thread(target=self._load)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load(self):
+        try:
+            db = DB(dbname=self.dbname)
+            db.connect()
+            try:
+                cursor = db.conn.cursor()
+                cursor.execute("LOAD DATA LOCAL INFILE '" + self.path + "' INTO TABLE " + self.tablename +
+                               " CHARACTER SET utf8 (" + ",".join(self.columns) + ");")
+                self.rows = cursor.rowcount
+            finally:
+                db.conn.close()
+        except Exception, e:
+            logging.exception("Loading %s from %s failed" % (self.tablename, self.path))
+            self.error = e
+
+    def _openWriter(self):
+        """
+        A nonblocking write descriptor for the pipe, or None if nothing
+        is reading it yet.
+        """
+        import errno
+        try:
+            return os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            if e.errno != errno.ENXIO:
+                raise
+            return None
+
+    def open(self):
+        """
+        Open the pipe for writing as soon as MySQL has it open for reading.
+        """
+        import fcntl
+        import time
+        fd = self._openWriter()
+        while fd is None:
+            if not self.thread.is_alive():
+                raise self.error or IOError("Nothing ever read from " + self.path)
+            time.sleep(0.05)
+            fd = self._openWriter()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        self.opened = True
+        return os.fdopen(fd, "w")
+
+    def finish(self):
+        """
+        Wait for the load to end (the writer should be closed first), and
+        remove the pipe. If nothing was ever written, the load is sent an
+        end of file so that it doesn't wait forever.
+        """
+        import time
+        while not self.opened and self.thread.is_alive():
+            fd = self._openWriter()
+            if fd is not None:
+                os.close(fd)
+                break
+            time.sleep(0.05)
+        self.thread.join()
+        os.remove(self.path)
+        elapsed = max(time.time() - self.start, 0.001)
+        logging.info("Streamed %d rows into %s in %.1f s (%d rows/s)" %
+                     (self.rows, self.tablename, elapsed, self.rows / elapsed))
+
 class BookwormSQLDatabase:
 
     """
@@ -179,6 +530,15 @@ class BookwormSQLDatabase:
         self.conn = None
 
         self.db = DB(dbname=self.dbname)
+        # Set to False where the server forbids LOAD DATA LOCAL INFILE: counts
+        # are then inserted directly, `insert_rows` at a time.
+        self.local_infile = True
+        self.insert_rows = 5000
+        # Whether an append reads every already-loaded file to compare its
+        # md5 with the manifest, rather than trusting its size and mtime.
+        self.verify_checksums = False
+        # The unigram files an append has loaded, for `update_book_counts`.
+        self.appended_unigrams = []
         
         if variableFile is not None:
             self.setVariables(originFile=variableFile)
@@ -254,15 +614,86 @@ class BookwormSQLDatabase:
         );""")
 
         db.query("ALTER TABLE words DISABLE KEYS")
-        logging.info("loading data using LOAD DATA LOCAL INFILE")
-        db.query("""LOAD DATA LOCAL INFILE '.bookworm/texts/wordlist/wordlist.txt'
-                   INTO TABLE words
-                   CHARACTER SET binary
-                   (wordid,word,count) """)
+        self.load_word_file(".bookworm/texts/wordlist/wordlist.txt", "words")
         logging.info("creating indexes on words table")
         db.query("ALTER TABLE words ENABLE KEYS")
         db.query("UPDATE words SET casesens=word")
 
+    def load_word_file(self, path, tablename):
+        """
+        Load a file in the format of wordlist.txt (wordid, word, count) into
+        `tablename`, inserting its rows `insert_rows` at a time if LOAD DATA
+        LOCAL INFILE isn't allowed.
+        """
+        db = self.db
+        if self.local_infile:
+            logging.info("loading data using LOAD DATA LOCAL INFILE")
+            try:
+                db.query("""LOAD DATA LOCAL INFILE '%s'
+                           INTO TABLE %s
+                           CHARACTER SET binary
+                           (wordid,word,count) """ % (path, tablename))
+                return
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.local_infile_failed(e)
+                logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+        import itertools
+        lines = open(path)
+        try:
+            while True:
+                batch = []
+                for line in itertools.islice(lines, self.insert_rows):
+                    (wordid, word, count) = line.rstrip("\n").split("\t")
+                    batch.append((int(wordid), word.replace("\\\\", "\\"), int(count)))
+                if len(batch) == 0:
+                    break
+                db.query("INSERT INTO " + tablename + " (wordid,word,count) VALUES (%s,%s,%s)", many_params=batch)
+        finally:
+            lines.close()
+        db.conn.commit()
+
+    def update_word_list(self):
+        """
+        Applies `.bookworm/texts/wordlist/delta.txt`, as written by an
+        incremental `word_db`, to the existing words and wordsheap tables:
+        changed counts are updated and new words inserted, so neither has to be
+        rebuilt. wordsheap's definition in masterTableTable already reads
+        from words, so a later reload picks up the same words.
+
+        Returns the highest wordid from before the delta, so that
+        `update_Porter_stemming` can stem just the words it added.
+        """
+        db = self.db
+        logging.info("Loading the wordlist delta")
+        previous = db.query("SELECT MAX(wordid) FROM words").fetchall()[0][0] or 0
+        # Not a TEMPORARY table: a reconnect would silently drop that.
+        db.query("DROP TABLE IF EXISTS words_delta")
+        db.query("""CREATE TABLE words_delta (
+        wordid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (wordid),
+        word VARCHAR(255),
+        count BIGINT UNSIGNED
+        );""")
+        try:
+            self.load_word_file(".bookworm/texts/wordlist/delta.txt", "words_delta")
+            db.query("""UPDATE words JOIN words_delta USING (wordid)
+                        SET words.count = words_delta.count""")
+            db.query("""INSERT INTO words (wordid,word,count,casesens)
+                        SELECT words_delta.wordid,words_delta.word,words_delta.count,words_delta.word
+                        FROM words_delta LEFT JOIN words USING (wordid)
+                        WHERE words.wordid IS NULL""")
+            try:
+                db.query("""INSERT IGNORE INTO wordsheap (wordid,word,casesens,lowercase)
+                            SELECT wordid,word,word,LOWER(word) FROM words_delta
+                            WHERE CHAR_LENGTH(word) <= 30 AND wordid <= 1500000""")
+            except MySQLdb.Error, e:
+                logging.warning("wordsheap not updated (%s): it will be rebuilt from words on the next reload" % e)
+            self.forget_memory_snapshot("wordsheap")
+        finally:
+            db.query("DROP TABLE IF EXISTS words_delta")
+        return previous
+
     def load_book_list(self):
         """
         Loads in the tables that have already been created by a previous
@@ -270,36 +701,39 @@ class BookwormSQLDatabase:
         """
         self.variableSet.loadMetadata()
 
-    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1):
+    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1, workers=1,
+                                   wordid_partitions=0, append=False):
+        """
+        Loads the encoded unigram counts into master_bookcounts, or with
+        table_count > 1, into master_bookcounts_p1...pN under a MERGE table
+        of that name. `workers` is the number of tables loaded at once,
+        each over its own connection.
+
+        Alternatively, wordid_partitions > 1 splits the single table into
+        that many native MySQL partitions by ranges of wordid, each holding
+        about the same share of the words in the wordlist (see
+        `wordid_partition_bounds`). A search for a word then reads only the
+        partition that holds it.
+
+        Every file loaded is recorded in the `loaded_count_files` manifest.
+        With `append`, the existing tables are kept and only the files not in
+        the manifest are loaded, with the indexes left live.
+        """
         import time
         t0 = time.time()
 
         db = self.db
         ngramname = "unigrams"
         tablenameroot = "master_bookcounts"
-        # If you are splitting the input into multiple tables
-        # to be joined as a merge table, come up with multiple 
-        # table names and we'll cycle through.
-        if table_count == 1:
-            tablenames = [tablenameroot]
-        elif table_count > 1:
-            tablenames = ["%s_p%d" % (tablenameroot, i) for i in range(1, table_count+1)]
-        else:
-            logging.error("You need a positive integer for table_count")
-            raise
+        tablenames = count_table_names(tablenameroot, table_count)
+        partition_sql = wordid_partition_sql("wordid", wordid_partitions, table_count)
 
         grampath =  ".bookworm/texts/encoded/%s" % ngramname
-        tmpdir = "%s/tmp" % grampath
+        if append:
+            newtable = False
 
-        if (len(grampath) == 0) or (grampath == "/"):
-            logging.error("Woah! Don't set the ngram path to your system root!")
-            raise
-        
         if newtable:
-            if os.path.exists(tmpdir):
-                import shutil
-                shutil.rmtree(tmpdir)
-        
+            self.clear_manifest(tablenameroot)
             logging.info("Dropping older %s table, if it exists" % ngramname)
             for tablename in tablenames:
                 db.query("DROP TABLE IF EXISTS " + tablename)
@@ -307,92 +741,27 @@ class BookwormSQLDatabase:
         logging.info("Making a SQL table to hold the %s" % ngramname)
         reverse_index_sql = "INDEX(bookid,wordid,count), " if reverse_index else ""
         for tablename in tablenames:
-            db.query("CREATE TABLE IF NOT EXISTS " + tablename + " ("
+            self.create_count_table(db, tablename,
                 "bookid MEDIUMINT UNSIGNED NOT NULL, " + reverse_index_sql +
                 "wordid MEDIUMINT UNSIGNED NOT NULL, INDEX(wordid,bookid,count), "
-                "count MEDIUMINT UNSIGNED NOT NULL);")
+                "count MEDIUMINT UNSIGNED NOT NULL", partition_sql)
 
         if ingest:
-            for tablename in tablenames:
-                db.query("ALTER TABLE " + tablename + " DISABLE KEYS")
+            if not append:
+                # Rebuilding the indexes of a big table is slower than
+                # updating them for a few new rows.
+                for tablename in tablenames:
+                    db.query("ALTER TABLE " + tablename + " DISABLE KEYS")
             db.query("set NAMES utf8;")
             db.query("set CHARACTER SET utf8;")
             logging.info("loading data using LOAD DATA LOCAL INFILE")
             
-            files = os.listdir(grampath)
-            for i, filename in enumerate(files):
-                if filename.endswith('.txt'):
-                    # With each input file, cycle through each table in tablenames
-                    tablename = tablenames[i % len(tablenames)]
-                    logging.debug("Importing txt file, %s (%d/%d)" % (filename, i, len(files)))
-                    try:
-                        db.query("LOAD DATA LOCAL INFILE '" + grampath + "/" + filename + "' INTO TABLE " + tablename +" CHARACTER SET utf8 (bookid,wordid,count);")
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                       logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
-                       try:
-                            import pandas as pd
-                            df = pd.read_csv(grampath + "/" + filename, sep='\t', header=None)
-                            to_insert = df.apply(tuple, axis=1).tolist()
-                            db.query(
-                                "INSERT INTO " + tablename + " (bookid,wordid,count) "
-                                "VALUES (%s, %s, %s);""",
-                                many_params=to_insert
-                                )
-                       except KeyboardInterrupt:
-                           raise
-                       except:
-                           logging.exception("Error inserting %s from %s" % (ngramname, filename))
-                           continue
-
-                elif filename.endswith('.h5'):
-                    logging.info("Importing h5 file, %s (%d/%d)" % (filename, i, len(files)))
-                    try:
-                        # When encountering an .h5 file, this looks for ngram information
-                        # in a /#{ngramnames} table (e.g. /unigrams) and writes it out to
-                        # temporary TSV files.
-                        # Dask is used here simply because it's a dead simple way to multithread
-                        # the TSV writing and lower the overhead versus having a TSV already staged.
-                        import csv
-                        import pandas as pd
-                        try:
-                            import dask.dataframe as dd
-                        except:
-                            logging.exception("Ingesting h5 files requires dask")
-                        try:
-                            os.makedirs(tmpdir)
-                        except OSError:
-                            if not os.path.isdir(tmpdir):
-                                raise
-                        # Dask will use #{n_cores-1} threads when saving CSVs.
-                        # Ingest and key reload times are identical to txt import, so the only
-                        # additional overhead is reading the file (small effect) and writing the csv.
-                        ddf = dd.read_hdf(grampath + "/" + filename,
-                                          ngramname, mode='r', chunksize=2000000)
-                        ddf.reset_index().to_csv(tmpdir + '/tmp.*.tsv',
-                                                 index=False, sep='\t', header=False,
-                                                 quoting=csv.QUOTE_NONNUMERIC)
-                        logging.info("CSV written from H5. Time passed: %.2f s" % (time.time() - t0))
-                        for j, tmpfile in enumerate(os.listdir(tmpdir)):
-                            # With each input file, cycle through each table in tablenames
-                            tablename = tablenames[j % len(tablenames)]
-                            path = "%s/%s" % (tmpdir, tmpfile)
-                            db.query("LOAD DATA LOCAL INFILE '" + path + "' "
-                                     "INTO TABLE " + tablename + " "
-                                     "CHARACTER SET utf8 (bookid,wordid,count);")
-                            try:
-                                os.remove(path)
-                            except:
-                                pass
-                        logging.info("CSVs input. Time passed: %.2f s" % (time.time() - t0))
-                    except KeyboardInterrupt:
-                       raise
-                    except:
-                       logging.exception("Error inserting %s from %s" % (ngramname, filename))
-                       continue
-                else:
-                    continue
+            # Each table is loaded on its own connection with more than one worker.
+            assignments = count_file_assignments(grampath, tablenames)
+            if append:
+                assignments = self.unloaded_files(tablenameroot, assignments)
+                self.appended_unigrams = [entry for paths in assignments.values() for entry in paths]
+            self.load_count_files(assignments, ["bookid","wordid","count"], workers=workers, manifest=tablenameroot)
         if index:
             logging.info("Creating Unigram Indexes. Time passed: %.2f s" % (time.time() - t0))
             for tablename in tablenames:
@@ -408,24 +777,500 @@ class BookwormSQLDatabase:
 
         logging.info("Unigram index created in: %.2f s" % ((time.time() - t0)))
 
-    def create_bigram_book_counts(self):
+    def create_bigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=False, table_count=1, workers=1,
+                                  wordid_partitions=0, append=False):
+        """
+        Loads the encoded bigram counts into master_bigrams, with the same
+        options as `create_unigram_book_counts`: table_count splits it into
+        master_bigrams_p1...pN under a MERGE table, loaded `workers` at a
+        time, or wordid_partitions splits it natively by ranges of word1.
+
+        reverse_index adds a bookid-first index, (bookid,word1,word2,count),
+        for queries that start from the texts; it's off by default, since
+        bigram tables are so large. `append` loads only new files, as for
+        unigrams.
+        """
+        import time
+        t0 = time.time()
         db = self.db
+        tablenameroot = "master_bigrams"
+        tablenames = count_table_names(tablenameroot, table_count)
+        partition_sql = wordid_partition_sql("word1", wordid_partitions, table_count)
+        columns = ["bookid","word1","word2","count"]
+        if append:
+            newtable = False
+
+        if newtable:
+            self.clear_manifest(tablenameroot)
+            logging.info("Dropping older bigrams table, if it exists")
+            for tablename in tablenames:
+                db.query("DROP TABLE IF EXISTS " + tablename)
+
         logging.info("Making a SQL table to hold the bigram counts")
-        db.query("""DROP TABLE IF EXISTS master_bigrams""")
-        db.query("""CREATE TABLE master_bigrams (
-        bookid MEDIUMINT UNSIGNED NOT NULL,
-        word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,bookid,count),
-        word2 MEDIUMINT UNSIGNED NOT NULL,
-        count MEDIUMINT UNSIGNED NOT NULL);""")
-        db.query("ALTER TABLE master_bigrams DISABLE KEYS")
-        logging.info("loading data using LOAD DATA LOCAL INFILE")
-        for filename in os.listdir(".bookworm/texts/encoded/bigrams"):
+        reverse_index_sql = "INDEX(bookid,word1,word2,count), " if reverse_index else ""
+        for tablename in tablenames:
+            self.create_count_table(db, tablename,
+                "bookid MEDIUMINT UNSIGNED NOT NULL, " + reverse_index_sql +
+                "word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,bookid,count), "
+                "word2 MEDIUMINT UNSIGNED NOT NULL, "
+                "count MEDIUMINT UNSIGNED NOT NULL", partition_sql)
+
+        if ingest:
+            if not append:
+                for tablename in tablenames:
+                    db.query("ALTER TABLE " + tablename + " DISABLE KEYS")
+            logging.info("loading data using LOAD DATA LOCAL INFILE")
+            assignments = count_file_assignments(".bookworm/texts/encoded/bigrams", tablenames)
+            if append:
+                assignments = self.unloaded_files(tablenameroot, assignments)
+            self.load_count_files(assignments, columns, workers=workers, manifest=tablenameroot)
+
+        if index:
+            logging.info("Creating bigram indexes. Time passed: %.2f s" % (time.time() - t0))
+            for tablename in tablenames:
+                db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+            if table_count > 1:
+                logging.info("Creating a merge table for " + ",".join(tablenames))
+                db.query("CREATE TABLE IF NOT EXISTS " + tablenameroot + " ("
+                    "bookid MEDIUMINT UNSIGNED NOT NULL, " + reverse_index_sql +
+                    "word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,bookid,count), "
+                    "word2 MEDIUMINT UNSIGNED NOT NULL, "
+                    "count MEDIUMINT UNSIGNED NOT NULL) "
+                    "ENGINE=MERGE UNION=(" + ",".join(tablenames) + ") INSERT_METHOD=LAST;")
+        logging.info("Bigram tables built in: %.2f s" % (time.time() - t0))
+
+    def create_trigram_book_counts(self, newtable=True, ingest=True, index=True, table_count=1, workers=1,
+                                   wordid_partitions=0, partitions=16, append=False):
+        """
+        Loads the encoded trigram counts into master_trigrams, with the same
+        options as `create_bigram_book_counts`.
+
+        Trigrams are far more numerous than bigrams, so unless it is split
+        some other way the table is split into `partitions` hash partitions
+        on the first word: a phrase search only has to read the index of the
+        one partition its first word is in.
+        """
+        import time
+        t0 = time.time()
+        db = self.db
+        tablenameroot = "master_trigrams"
+        tablenames = count_table_names(tablenameroot, table_count)
+        partition_sql = wordid_partition_sql("word1", wordid_partitions, table_count)
+        if partition_sql == "" and table_count == 1 and partitions > 1:
+            partition_sql = " PARTITION BY HASH(word1) PARTITIONS %d" % partitions
+        columns = ["bookid","word1","word2","word3","count"]
+        definition = ("bookid MEDIUMINT UNSIGNED NOT NULL, "
+                      "word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,word3,bookid,count), "
+                      "word2 MEDIUMINT UNSIGNED NOT NULL, "
+                      "word3 MEDIUMINT UNSIGNED NOT NULL, "
+                      "count MEDIUMINT UNSIGNED NOT NULL")
+        if append:
+            newtable = False
+
+        if newtable:
+            self.clear_manifest(tablenameroot)
+            logging.info("Dropping older trigrams table, if it exists")
+            for tablename in tablenames:
+                db.query("DROP TABLE IF EXISTS " + tablename)
+
+        logging.info("Making a SQL table to hold the trigram counts")
+        for tablename in tablenames:
+            self.create_count_table(db, tablename, definition, partition_sql)
+
+        if ingest:
+            if not append:
+                for tablename in tablenames:
+                    db.query("ALTER TABLE " + tablename + " DISABLE KEYS")
+            logging.info("loading data using LOAD DATA LOCAL INFILE")
+            assignments = count_file_assignments(".bookworm/texts/encoded/trigrams", tablenames)
+            if append:
+                assignments = self.unloaded_files(tablenameroot, assignments)
+            self.load_count_files(assignments, columns, workers=workers, manifest=tablenameroot)
+
+        if index:
+            logging.info("Creating trigram indexes. Time passed: %.2f s" % (time.time() - t0))
+            for tablename in tablenames:
+                db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+            if table_count > 1:
+                logging.info("Creating a merge table for " + ",".join(tablenames))
+                db.query("CREATE TABLE IF NOT EXISTS " + tablenameroot + " (" + definition + ") "
+                    "ENGINE=MERGE UNION=(" + ",".join(tablenames) + ") INSERT_METHOD=LAST;")
+        logging.info("Trigram tables built in: %.2f s" % (time.time() - t0))
+
+    def create_count_table(self, db, tablename, definition, partition_sql=""):
+        """
+        Creates a count table with the column and index `definition`, if it
+        doesn't exist. If the server won't partition it (MySQL 8 can't
+        partition MyISAM tables at all), it is created unpartitioned instead.
+        """
+        sql = "CREATE TABLE IF NOT EXISTS " + tablename + " (" + definition + ")"
+        try:
+            db.query(sql + partition_sql + ";")
+        except MySQLdb.Error, e:
+            if partition_sql == "":
+                raise
+            logging.warning("The server can't partition %s (%s): creating it unpartitioned" % (tablename, e))
+            db.query(sql + ";")
+
+    def stream_wordcounts(self, input, processes=1, levels=["unigrams","bigrams"], source="raw_text", stem_processes=1):
+        """
+        Encodes bookworm-formatted text (or count shards, with
+        source="counts") from `input` and loads the counts into fresh
+        count tables in the same pass. Each level's counts are written into
+        a named pipe that a `LOAD DATA LOCAL INFILE` is reading from, so
+        encoding and loading overlap and no encoded files are written at all.
+
+        This always builds the tables from scratch; use the encoded files
+        to resume or add to a build. The words table is loaded (and stemmed
+        in `stem_processes`, unless that is 0) first, as
+        `database_wordcounts` does.
+        """
+        import time
+        from bookwormDB.tokenizer import encode_rows_to_files
+        t0 = time.time()
+        tables = {
+            "unigrams": ("master_bookcounts", ["bookid","wordid","count"]),
+            "bigrams": ("master_bigrams", ["bookid","word1","word2","count"]),
+            "trigrams": ("master_trigrams", ["bookid","word1","word2","word3","count"])
+        }
+        self.load_word_list()
+        if stem_processes > 0:
+            self.update_Porter_stemming(processes=stem_processes)
+        if "unigrams" in levels:
+            self.create_unigram_book_counts(ingest=False, index=False)
+            self.db.query("ALTER TABLE master_bookcounts DISABLE KEYS")
+        if "bigrams" in levels:
+            self.create_bigram_book_counts(ingest=False, index=False)
+            self.db.query("ALTER TABLE master_bigrams DISABLE KEYS")
+        if "trigrams" in levels:
+            self.create_trigram_book_counts(ingest=False, index=False)
+            self.db.query("ALTER TABLE master_trigrams DISABLE KEYS")
+
+        pipedir = ".bookworm/texts/encoded/pipes"
+        try:
+            os.makedirs(pipedir)
+        except OSError:
+            if not os.path.isdir(pipedir):
+                raise
+        loaders = []
+        outputs = dict()
+        nwordsFile = None
+        if "unigrams" in levels:
+            # The tables are new, so any word totals from an earlier build
+            # are stale.
+            nwordsDir = ".bookworm/texts/encoded/nwords"
+            if os.path.isdir(nwordsDir):
+                for filename in os.listdir(nwordsDir):
+                    os.remove(os.path.join(nwordsDir, filename))
+            else:
+                os.makedirs(nwordsDir)
+            nwordsFile = open(os.path.join(nwordsDir, "stream.%d.txt" % os.getpid()), "w")
+        try:
+            for level in levels:
+                (tablename, columns) = tables[level]
+                path = os.path.join(pipedir, "%s.%d.fifo" % (level, os.getpid()))
+                if os.path.exists(path):
+                    os.remove(path)
+                os.mkfifo(path)
+                loader = pipeLoader(self.dbname, path, tablename, columns)
+                loaders.append(loader)
+                outputs[level] = loader.open()
+            rows = (line.rstrip("\n") for line in input)
+            encode_rows_to_files(rows, outputs, processes=processes, levels=levels, source=source, nwordsFile=nwordsFile)
+        finally:
+            if nwordsFile is not None:
+                nwordsFile.close()
+            for output in outputs.values():
+                try:
+                    output.close()
+                except IOError:
+                    pass
+            for loader in loaders:
+                loader.finish()
+        for loader in loaders:
+            if loader.error is not None:
+                raise loader.error
+        logging.info("Encoded and loaded in %.2f s; creating indexes" % (time.time() - t0))
+        for loader in loaders:
+            self.db.query("ALTER TABLE " + loader.tablename + " ENABLE KEYS")
+        logging.info("Streaming build finished in %.2f s" % (time.time() - t0))
+
+    def create_manifest(self):
+        """
+        The manifest of encoded files already loaded into each count table,
+        so that an append only loads the new ones.
+        """
+        self.db.query("""CREATE TABLE IF NOT EXISTS loaded_count_files (
+        counts VARCHAR(64) NOT NULL,
+        filename VARCHAR(255) NOT NULL,
+        part SMALLINT UNSIGNED NOT NULL,
+        size BIGINT UNSIGNED,
+        mtime DOUBLE,
+        checksum CHAR(32),
+        rowcount BIGINT UNSIGNED,
+        loaded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (counts,filename,part)
+        );""")
+
+    def clear_manifest(self, counts):
+        self.create_manifest()
+        self.db.query("DELETE FROM loaded_count_files WHERE counts=%s", many_params=[(counts,)])
+
+    def unloaded_files(self, counts, assignments):
+        """
+        Filter `assignments` (as for `load_count_files`) down to the files
+        the manifest doesn't list as loaded into `counts`, matching them by
+        name. A listed file with a new size or modification time is skipped
+        with a warning, since loading it again would double its counts, so
+        that needs a rebuild.
+
+        With `verify_checksums`, the files that do match are also read for
+        their md5, which is compared with the one from the last verified
+        append, or recorded if there wasn't one. Loading never computes it,
+        so a full build doesn't read every file twice.
+        """
+        self.create_manifest()
+        loaded = dict()
+        for (filename, part, size, mtime, checksum) in self.db.query(
+                "SELECT filename,part,size,mtime,checksum FROM loaded_count_files "
+                "WHERE counts='%s'" % counts).fetchall():
+            loaded[(filename, part)] = (size, mtime, checksum)
+        remaining = dict()
+        skipped = 0
+        for (tablename, paths) in assignments.iteritems():
+            remaining[tablename] = []
+            for entry in paths:
+                (path, part) = (entry[0], entry[1]) if isinstance(entry, tuple) else (entry, 0)
+                key = (os.path.basename(path), part)
+                if key not in loaded:
+                    remaining[tablename].append(entry)
+                    continue
+                skipped += 1
+                (size, mtime, checksum) = loaded[key]
+                changed = size != os.path.getsize(path) or mtime != os.path.getmtime(path)
+                if not changed and self.verify_checksums:
+                    current = file_checksum(path)
+                    if checksum is None:
+                        self.db.query("UPDATE loaded_count_files SET checksum=%s WHERE counts=%s AND filename=%s AND part=%s",
+                                      many_params=[(current, counts, key[0], part)])
+                    changed = checksum is not None and checksum != current
+                if changed:
+                    logging.warning("%s has changed since it was loaded into %s: skipping it. Rebuild the table to pick up the changes." % (path, counts))
+        logging.info("%d files already loaded into %s; loading %d new ones" %
+                     (skipped, counts, sum(len(paths) for paths in remaining.values())))
+        return remaining
+
+    def update_book_counts(self):
+        """
+        After appending the counts for new texts, computes nwords again for
+        just the books in the unigram files that were appended (see
+        `variableSet.createNwordsFile`), which may include books that already
+        had counts, and brings fastcat up to date, rather than rebuilding
+        either.
+        """
+        logging.info("Updating nwords and fastcat for the new books")
+        bookids = set()
+        for entry in self.appended_unigrams:
+            bookids.update(count_file_bookids(*entry) if isinstance(entry, tuple) else count_file_bookids(entry))
+        self.variableSet.createNwordsFile(bookids=bookids, local_infile=self.local_infile, insert_rows=self.insert_rows)
+        try:
+            self.db.query("UPDATE fastcat JOIN catalog USING (bookid) SET fastcat.nwords = catalog.nwords "
+                          "WHERE fastcat.nwords <> catalog.nwords")
+            self.db.query("INSERT IGNORE INTO fastcat " + self.fastcat_select() +
+                          " WHERE catalog.bookid NOT IN (SELECT bookid FROM fastcat)")
+        except MySQLdb.Error, e:
+            logging.warning("fastcat not updated (%s): it will be rebuilt from the catalog on the next reload" % e)
+        self.forget_memory_snapshot("fastcat")
+
+    def load_count_files(self, assignments, columns, workers=1, manifest=None):
+        """
+        Load encoded count files into tables. `assignments` maps each table
+        name to the list of files that go into it. An HDF5 store can be given
+        as (path, part, parts) to load just every `parts`th chunk of it,
+        starting from number `part`.
+
+        With workers > 1, that many threads each take a table at a time and
+        load all of its files over their own connection, so that separate
+        tables fill concurrently. (Loads into any one table still run one after
+        another, since each takes a lock on the whole table.) The rows and
+        bytes loaded per second are logged for every table.
+
+        With `manifest`, the name of the count table the files belong to,
+        each file that loads is recorded in the manifest (see
+        `unloaded_files`).
+        """
+        import threading
+        import Queue
+        tablenames = [tablename for tablename in sorted(assignments) if len(assignments[tablename]) > 0]
+        workers = min(workers, len(tablenames))
+        if workers <= 1:
+            for tablename in tablenames:
+                self.load_table_files(self.db, tablename, assignments[tablename], columns, manifest=manifest)
+            return
+
+        logging.info("Loading %d tables over %d connections" % (len(tablenames), workers))
+        queue = Queue.Queue()
+        for tablename in tablenames:
+            queue.put(tablename)
+        errors = []
+
+        def work():
+            try:
+                db = DB(dbname=self.dbname)
+                db.connect()
+                try:
+                    while len(errors) == 0:
+                        try:
+                            tablename = queue.get_nowait()
+                        except Queue.Empty:
+                            return
+                        self.load_table_files(db, tablename, assignments[tablename], columns, manifest=manifest)
+                finally:
+                    db.conn.close()
+            except Exception, e:
+                logging.exception("A loader connection failed")
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def load_table_files(self, db, tablename, paths, columns, manifest=None):
+        """
+        Load a list of text or packed count files into one table over the
+        connection `db`, and log the throughput. A file that fails to load is
+        logged and skipped; one that loads is recorded under `manifest`, if
+        given.
+        """
+        import time
+        t0 = time.time()
+        rows = 0
+        size = 0
+        for i, path in enumerate(paths):
+            (part, parts) = (0, 1)
+            if isinstance(path, tuple):
+                (path, part, parts) = path
+            logging.debug("Importing %s into %s (%d/%d)" % (path, tablename, i, len(paths)))
             try:
-                db.query("LOAD DATA LOCAL INFILE '.bookworm/texts/encoded/bigrams/"+filename+"' INTO TABLE master_bigrams CHARACTER SET utf8 (bookid,word1,word2,count);")
+                if path.endswith('.bin'):
+                    loaded = self.load_packed_counts(path, tablename, columns, db=db)
+                elif path.endswith('.h5'):
+                    loaded = self.load_h5_counts(path, tablename, columns, db=db, part=part, parts=parts)
+                else:
+                    loaded = self.load_text_counts(path, tablename, columns, db=db)
+                rows += loaded
+                size += os.path.getsize(path) / parts
+                if manifest is not None:
+                    # The checksum is left for a verified append (see `unloaded_files`).
+                    db.query("REPLACE INTO loaded_count_files (counts,filename,part,size,mtime,rowcount) "
+                             "VALUES (%s,%s,%s,%s,%s,%s)",
+                             many_params=[(manifest, os.path.basename(path), part, os.path.getsize(path),
+                                           os.path.getmtime(path), loaded)])
+            except KeyboardInterrupt:
+                raise
             except:
+                logging.exception("Error inserting into %s from %s" % (tablename, path))
+                continue
+        elapsed = max(time.time() - t0, 0.001)
+        logging.info("Loaded %d files into %s in %.1f s: %d rows (%d rows/s), %.1f MB (%.1f MB/s)" %
+                     (len(paths), tablename, elapsed, rows, rows / elapsed,
+                      size / 1e6, size / 1e6 / elapsed))
+
+    def local_infile_failed(self, error):
+        """
+        Called when a LOAD DATA fails. If the server forbids it outright,
+        later files skip straight to inserting.
+        """
+        if self.local_infile and getattr(error, "args", (None,))[0] in (1148, 3948):
+            logging.warning("This server doesn't allow LOAD DATA LOCAL INFILE: inserting rows directly instead")
+            self.local_infile = False
+
+    def load_text_counts(self, path, tablename, columns, db=None):
+        """
+        Load a tab-separated count file into `tablename`, falling back to
+        inserting its rows directly if LOAD DATA fails. Returns the number of
+        rows loaded.
+        """
+        if db is None:
+            db = self.db
+        if self.local_infile:
+            try:
+                cursor = db.query("LOAD DATA LOCAL INFILE '" + path + "' INTO TABLE " + tablename +
+                                  " CHARACTER SET utf8 (" + ",".join(columns) + ");")
+                return cursor.rowcount
+            except KeyboardInterrupt:
                 raise
-        logging.info("Creating bigram indexes")
-        db.query("ALTER TABLE master_bigrams ENABLE KEYS")
+            except Exception, e:
+                self.local_infile_failed(e)
+                logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+        input = open(path)
+        try:
+            return bulk_insert(db, insert_statements_from_text(input, tablename, columns, self.insert_rows))
+        finally:
+            input.close()
+
+    def load_h5_counts(self, path, tablename, columns, db=None, part=0, parts=1):
+        """
+        Load counts from an HDF5 store, which holds them in a table named for
+        the ngram level (e.g. /unigrams), with any columns that are in its
+        index first. Chunks are read with pandas (see `h5_records`) and
+        streamed through a named pipe into LOAD DATA, or inserted directly,
+        without ever being written out as text. Returns the number of rows loaded.
+        """
+        from bookwormDB.packedCounts import textPipe, NGRAM_LENGTHS
+        if db is None:
+            db = self.db
+        key = [level for (level, length) in NGRAM_LENGTHS.iteritems() if length + 2 == len(columns)][0]
+        records = lambda: h5_records(path, key, len(columns), part=part, parts=parts)
+        if self.local_infile:
+            try:
+                with textPipe(path, len(columns), os.path.join(os.path.dirname(path), "pipes"), records=records()) as pipe:
+                    if db.conn is None:
+                        db.connect()
+                    cursor = db.conn.cursor()
+                    cursor.execute("LOAD DATA LOCAL INFILE '" + pipe.path + "' INTO TABLE " + tablename +
+                                   " CHARACTER SET utf8 (" + ",".join(columns) + ");")
+                    return cursor.rowcount
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.local_infile_failed(e)
+                logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+        return bulk_insert(db, insert_statements_from_records(records(), tablename, columns, self.insert_rows))
+
+    def load_packed_counts(self, path, tablename, columns, db=None):
+        """
+        Load a packed binary count file (see `bookwormDB.packedCounts`) into
+        `tablename`. A background thread writes it out as text into a named
+        pipe that LOAD DATA reads from; if that fails, the records are
+        inserted directly, a chunk at a time. Returns the number of rows loaded.
+        """
+        from bookwormDB.packedCounts import textPipe, readRecords
+        if db is None:
+            db = self.db
+        pipedir = os.path.join(os.path.dirname(path), "pipes")
+        if self.local_infile:
+            try:
+                with textPipe(path, len(columns), pipedir) as pipe:
+                    # Not through db.query: its retry would reopen a pipe
+                    # that has already been drained, and wait forever.
+                    if db.conn is None:
+                        db.connect()
+                    cursor = db.conn.cursor()
+                    cursor.execute("LOAD DATA LOCAL INFILE '" + pipe.path + "' INTO TABLE " + tablename +
+                                   " CHARACTER SET utf8 (" + ",".join(columns) + ");")
+                    return cursor.rowcount
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.local_infile_failed(e)
+                logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+        return bulk_insert(db, insert_statements_from_records(readRecords(path, len(columns)), tablename, columns,
+                                                              self.insert_rows))
 
     def loadVariableDescriptionsIntoDatabase(self):
         """
@@ -458,19 +1303,29 @@ class BookwormSQLDatabase:
         self.addWordsToMasterVariableTable()
         self.variableSet.updateMasterVariableTable()
 
-    def reloadMemoryTables(self,force=False):
+    def reloadMemoryTables(self, force=False, workers=1, snapshots=False):
         """
         Checks to see if memory tables need to be repopulated (by seeing if they are empty)
         and then does so if necessary.
+
+        With workers > 1, that many tables are rebuilt at once, each over its
+        own connection; a table whose `dependsOn` table is also being rebuilt
+        waits for it. With `snapshots`, a table is restored from the on-disk
+        copy saved when it was last built, if that is still current, and a
+        copy is saved of any table built from scratch (see
+        `save_memory_snapshot`). The seconds taken for each table are logged
+        and returned in a dict.
         """
-        existingCreateCodes = self.db.query("SELECT tablename,memoryCode FROM masterTableTable").fetchall()
-        for row in existingCreateCodes:
+        import time
+        existingCreateCodes = self.db.query("SELECT tablename,dependsOn,memoryCode FROM masterTableTable").fetchall()
+        codes = dict()
+        parents = dict()
+        for (tablename, dependsOn, code) in existingCreateCodes:
             """
             For each table, it checks to see if the table is currently populated; if not,
             it runs the stored code to repopulate the table. (It checks length because
             memory tables are emptied on a restart).
             """
-            tablename = row[0]
             try:
                 cursor = self.db.query("SELECT count(*) FROM %s" %(tablename), silent = True)
                 currentLength = cursor.fetchall()[0][0]
@@ -478,9 +1333,226 @@ class BookwormSQLDatabase:
             except:
                 currentLength = 0
             if currentLength==0 or force:
-                for query in splitMySQLcode(row[1]):
-                    self.db.query("SET optimizer_search_depth=0")
-                    self.db.query(query)
+                codes[tablename] = code
+                parents[tablename] = dependsOn
+        timings = dict()
+        if len(codes) == 0:
+            return timings
+        order = memory_table_order(parents)
+
+        # A table built from a parent that was just rebuilt from scratch
+        # is rebuilt from scratch too, rather than restored.
+        rebuilt = set()
+
+        def reload(db, tablename):
+            start = time.time()
+            source = self.reload_memory_table(db, tablename, codes[tablename], snapshots=snapshots,
+                                              force=force or parents[tablename] in rebuilt)
+            if source == "source":
+                rebuilt.add(tablename)
+            timings[tablename] = time.time() - start
+            logging.info("Reloaded %s from %s in %.2f seconds" % (tablename, source, timings[tablename]))
+
+        started = time.time()
+        workers = min(workers, len(order))
+        if workers <= 1:
+            for tablename in order:
+                reload(self.db, tablename)
+        else:
+            self.reload_concurrently(order, parents, reload, workers)
+        logging.info("Reloaded %d memory tables in %.2f seconds" % (len(order), time.time() - started))
+        return timings
+
+    def reload_concurrently(self, order, parents, reload, workers):
+        """
+        Runs `reload(db, tablename)` for each table in `order` across
+        `workers` threads with their own connections, starting a table only
+        once its parent (if any) has finished.
+        """
+        import threading
+        logging.info("Reloading %d memory tables over %d connections" % (len(order), workers))
+        condition = threading.Condition()
+        started = set()
+        done = set()
+        errors = []
+
+        def next_table():
+            with condition:
+                while len(errors) == 0 and len(started) < len(order):
+                    for tablename in order:
+                        if tablename not in started and (parents[tablename] is None or parents[tablename] in done):
+                            started.add(tablename)
+                            return tablename
+                    condition.wait()
+                return None
+
+        def work():
+            try:
+                db = DB(dbname=self.dbname)
+                db.connect()
+                try:
+                    while True:
+                        tablename = next_table()
+                        if tablename is None:
+                            return
+                        reload(db, tablename)
+                        with condition:
+                            done.add(tablename)
+                            condition.notify_all()
+                finally:
+                    db.conn.close()
+            except Exception, e:
+                logging.exception("A memory table reload failed")
+                with condition:
+                    errors.append(e)
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def reload_memory_table(self, db, tablename, code, force=False, snapshots=False):
+        """
+        Fills one memory table over the connection `db`: from its snapshot
+        if `snapshots` is set and one is current (and this isn't a forced
+        rebuild), and otherwise by running its stored `code`. Returns
+        "snapshot" or "source" accordingly.
+        """
+        if snapshots and not force and self.restore_memory_snapshot(db, tablename, code):
+            return "snapshot"
+        # Every stored code builds in a table called tmp: give each table
+        # its own, so that several can be built at once.
+        code = re.sub(r"\btmp\b", "tmp_" + tablename, code)
+        for query in splitMySQLcode(code):
+            db.query("SET optimizer_search_depth=0")
+            db.query(query)
+        if snapshots:
+            self.save_memory_snapshot(db, tablename, code)
+        else:
+            self.forget_memory_snapshot(tablename, db)
+        return "source"
+
+    def create_snapshot_manifest(self, db=None):
+        """
+        The record of the memory table snapshots: the checksum of the code
+        each was built from, of the state of the tables that code read (see
+        `memory_source_checksum`), and of the snapshot table itself.
+        """
+        db = db or self.db
+        db.query("""CREATE TABLE IF NOT EXISTS memoryTableSnapshots (
+        tablename VARCHAR(255) NOT NULL, PRIMARY KEY (tablename),
+        codeChecksum CHAR(32),
+        sourceChecksum CHAR(32),
+        tableChecksum BIGINT UNSIGNED,
+        rowcount BIGINT UNSIGNED,
+        taken TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=MYISAM;""")
+
+    def memory_source_checksum(self, db, code):
+        """
+        A checksum of the row counts and last update times of the disk
+        tables that a memory table's `code` names, so that a snapshot isn't
+        restored once any of them has changed (a reloaded catalog, say).
+        None if some of them don't record an update time, as InnoDB tables
+        may not: there is then no telling whether a snapshot is current.
+        """
+        names = set(re.findall(r"\w+", code))
+        if db.conn is None:
+            db.connect()
+        try:
+            # MySQL 8 otherwise caches these figures for up to a day. Sent
+            # straight to the connection, since 5.x doesn't have the setting
+            # and DB.query would reconnect on the error.
+            db.conn.cursor().execute("SET SESSION information_schema_stats_expiry=0")
+        except MySQLdb.Error:
+            pass
+        tables = db.query("SELECT TABLE_NAME,TABLE_ROWS,UPDATE_TIME FROM information_schema.TABLES "
+                          "WHERE TABLE_SCHEMA='%s' AND ENGINE<>'MEMORY'" % self.dbname).fetchall()
+        state = []
+        for (name, rows, updated) in sorted(tables):
+            if name not in names or name.endswith("_snapshot"):
+                continue
+            if updated is None:
+                return None
+            state.append("%s\t%s\t%s" % (name, rows, updated))
+        return memory_code_checksum("\n".join(state))
+
+    def save_memory_snapshot(self, db, tablename, code):
+        """
+        Copies a freshly built memory table to `<tablename>_snapshot`, a
+        MyISAM table with the same columns and indexes that lives on disk
+        and so survives a restart. Restoring it is a straight copy back into
+        memory, without the joins and scans that built the original.
+        """
+        snapshot = tablename + "_snapshot"
+        sourceChecksum = self.memory_source_checksum(db, code)
+        if sourceChecksum is None:
+            logging.info("Not saving a snapshot of %s: its sources don't record when they change" % tablename)
+            self.forget_memory_snapshot(tablename, db)
+            return
+        db.query("DROP TABLE IF EXISTS %s" % snapshot)
+        db.query("CREATE TABLE %s LIKE %s" % (snapshot, tablename))
+        db.query("ALTER TABLE %s ENGINE=MYISAM CHECKSUM=1" % snapshot)
+        db.query("INSERT INTO %s SELECT * FROM %s" % (snapshot, tablename))
+        tableChecksum = db.query("CHECKSUM TABLE %s QUICK" % snapshot).fetchall()[0][1]
+        rowcount = db.query("SELECT COUNT(*) FROM %s" % snapshot).fetchall()[0][0]
+        self.create_snapshot_manifest(db)
+        db.query("REPLACE INTO memoryTableSnapshots (tablename,codeChecksum,sourceChecksum,tableChecksum,rowcount) "
+                 "VALUES (%s,%s,%s,%s,%s)",
+                 many_params=[(tablename, memory_code_checksum(code), sourceChecksum, tableChecksum, rowcount)])
+        db.conn.commit()
+        logging.debug("Saved a snapshot of %s (%d rows)" % (tablename, rowcount))
+
+    def restore_memory_snapshot(self, db, tablename, code):
+        """
+        Refills a memory table from its snapshot, if there is one taken from
+        the same code and the same state of the tables it reads, and whose
+        own checksum still matches. Returns whether it did.
+        """
+        snapshot = tablename + "_snapshot"
+        code = re.sub(r"\btmp\b", "tmp_" + tablename, code)
+        try:
+            self.create_snapshot_manifest(db)
+            rows = db.query("SELECT codeChecksum,sourceChecksum,tableChecksum FROM memoryTableSnapshots "
+                            "WHERE tablename='%s'" % tablename).fetchall()
+            if len(rows) == 0:
+                return False
+            (codeChecksum, sourceChecksum, tableChecksum) = rows[0]
+            if codeChecksum != memory_code_checksum(code):
+                logging.info("The code for %s has changed since its snapshot: rebuilding it" % tablename)
+                return False
+            current = self.memory_source_checksum(db, code)
+            if current is None or current != sourceChecksum:
+                logging.info("The tables %s is built from have changed since its snapshot: rebuilding it" % tablename)
+                return False
+            current = db.query("CHECKSUM TABLE %s QUICK" % snapshot, silent=True).fetchall()[0][1]
+            if current is None or long(current) != long(tableChecksum):
+                logging.warning("The snapshot of %s doesn't match its checksum: rebuilding it" % tablename)
+                return False
+        except MySQLdb.Error, e:
+            logging.debug("No usable snapshot of %s (%s)" % (tablename, e))
+            return False
+        building = "tmp_" + tablename
+        db.query("DROP TABLE IF EXISTS %s" % building)
+        db.query("CREATE TABLE %s LIKE %s" % (building, snapshot))
+        db.query("ALTER TABLE %s ENGINE=MEMORY" % building)
+        db.query("INSERT INTO %s SELECT * FROM %s" % (building, snapshot))
+        db.query("DROP TABLE IF EXISTS %s" % tablename)
+        db.query("RENAME TABLE %s TO %s" % (building, tablename))
+        return True
+
+    def forget_memory_snapshot(self, tablename, db=None):
+        """
+        Marks a memory table's snapshot as out of date, for when the table
+        is built or changed without taking a new one.
+        """
+        db = db or self.db
+        self.create_snapshot_manifest(db)
+        db.query("DELETE FROM memoryTableSnapshots WHERE tablename='%s'" % tablename)
 
     def addFilesToMasterVariableTable(self):
         fastFieldsCreateList = ["bookid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (bookid)","nwords MEDIUMINT UNSIGNED NOT NULL"] +\
@@ -490,18 +1562,24 @@ class BookwormSQLDatabase:
         (""" +",\n".join(fastFieldsCreateList) + """
         ) ENGINE=MEMORY;"""
         #Also update the wordcounts for each text.
-        fastFields = ["bookid","nwords"] + [variable.fastField for variable in self.variableSet.variables if variable.unique and variable.fastSQL() is not None]
-        fileCommand += "INSERT INTO tmp SELECT " + ",".join(fastFields) + " FROM catalog USE INDEX () " + " ".join([" JOIN %(field)s__id USING (%(field)s ) " % variable.__dict__ for variable in self.variableSet.variables if variable.unique and variable.fastSQL() is not None and variable.datatype=="categorical"])+ ";"
+        fileCommand += "INSERT INTO tmp " + self.fastcat_select() + ";"
         fileCommand += "DROP TABLE IF EXISTS fastcat;"
         fileCommand += "RENAME TABLE tmp TO fastcat;"
         self.db.query('DELETE FROM masterTableTable WHERE masterTableTable.tablename="fastcat";')
         self.db.query("""INSERT IGNORE INTO masterTableTable VALUES
                    ('fastcat','fastcat','""" + fileCommand + """')""")
 
+    def fastcat_select(self):
+        """
+        The SELECT from catalog that fills fastcat.
+        """
+        fastFields = ["bookid","nwords"] + [variable.fastField for variable in self.variableSet.variables if variable.unique and variable.fastSQL() is not None]
+        return "SELECT " + ",".join(fastFields) + " FROM catalog USE INDEX () " + " ".join([" JOIN %(field)s__id USING (%(field)s ) " % variable.__dict__ for variable in self.variableSet.variables if variable.unique and variable.fastSQL() is not None and variable.datatype=="categorical"])
+
     def addWordsToMasterVariableTable(self):
         wordCommand = "DROP TABLE IF EXISTS tmp;"
-        wordCommand += "CREATE TABLE tmp (wordid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (wordid), word VARCHAR(30), INDEX (word), casesens VARBINARY(30),UNIQUE INDEX(casesens), lowercase CHAR(30), INDEX (lowercase) ) ENGINE=MEMORY;"
-        wordCommand += "INSERT IGNORE INTO tmp SELECT wordid as wordid,word,casesens,LOWER(word) FROM words WHERE CHAR_LENGTH(word) <= 30 AND wordid <= 1500000 ORDER BY wordid;"
+        wordCommand += "CREATE TABLE tmp (wordid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (wordid), word VARCHAR(30), INDEX (word), casesens VARBINARY(30),UNIQUE INDEX(casesens), lowercase CHAR(30), INDEX (lowercase), stem VARCHAR(30), INDEX (stem) ) ENGINE=MEMORY;"
+        wordCommand += "INSERT IGNORE INTO tmp SELECT wordid as wordid,word,casesens,LOWER(word),stem FROM words WHERE CHAR_LENGTH(word) <= 30 AND wordid <= 1500000 ORDER BY wordid;"
         wordCommand += "DROP TABLE IF EXISTS wordsheap;"
         wordCommand += "RENAME TABLE tmp TO wordsheap;"
         query = """INSERT IGNORE INTO masterTableTable
@@ -565,22 +1643,75 @@ class BookwormSQLDatabase:
         logging.info(addCode)
         db.query("INSERT INTO API_settings VALUES ('%s');" % addCode)
 
-    def update_Porter_stemming(self): #We use stems occasionally.
+    def update_Porter_stemming(self, processes=1, since=None):
         """
-        Still not executed.
+        Fills in the stem column of `words` for the words that don't have
+        one yet (all of them, after `load_word_list`), or with `since`, for
+        just those with a higher wordid (the ones `update_word_list` added),
+        which leaves out the old words that can't be stemmed. Stems are computed in
+        a pool of `processes` workers, written to
+        .bookworm/texts/wordlist/stems.txt, and applied with a single load
+        and join rather than an UPDATE per word. wordsheap, if it has been
+        built, is updated the same way.
         """
-        logging.info("Updating stems from Porter algorithm...")
-        from nltk import PorterStemmer
+        import bookwormDB.stemming
+        try:
+            import nltk
+        except ImportError:
+            logging.warning("nltk isn't installed, so the words can't be stemmed")
+            return
         db = self.db
+        logging.info("Updating stems from Porter algorithm...")
+        path = ".bookworm/texts/wordlist/stems.txt"
+        sql = "SELECT wordid,word FROM words WHERE stem IS NULL"
+        if since is not None:
+            sql += " AND wordid > %d" % since
+        cursor = db.query(sql)
+        output = open(path, "w")
+        try:
+            written = bookwormDB.stemming.writeStems(cursor, output, processes=processes)
+        finally:
+            output.close()
+        if written == 0:
+            os.remove(path)
+            return
 
-        stemmer = PorterStemmer()
-        cursor = db.query("""SELECT word FROM words""")
-        words = cursor.fetchall()
-        for local in words:
-            word = ''.join(local)  # Could probably take the first element of the tuple as well?
-            # Apostrophes have the save stem as the word, if they're included
-            word = word.replace("'s","")
-            if re.match("^[A-Za-z]+$",word):
-                query = """UPDATE words SET stem='""" + stemmer.stem(''.join(local)) + """' WHERE word='""" + ''.join(local) + """';"""
-                z = cursor.execute(query)
+        db.query("DROP TEMPORARY TABLE IF EXISTS word_stems")
+        db.query("""CREATE TEMPORARY TABLE word_stems (
+        wordid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (wordid),
+        stem VARCHAR(255)
+        );""")
+        loaded = False
+        if self.local_infile:
+            try:
+                db.query("""LOAD DATA LOCAL INFILE '%s'
+                           INTO TABLE word_stems
+                           CHARACTER SET binary
+                           (wordid,stem) """ % path)
+                loaded = True
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.local_infile_failed(e)
+                logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+        if not loaded:
+            import itertools
+            lines = open(path)
+            while True:
+                batch = [line.rstrip("\n").split("\t") for line in itertools.islice(lines, self.insert_rows)]
+                if len(batch) == 0:
+                    break
+                db.query("INSERT INTO word_stems (wordid,stem) VALUES (%s,%s)", many_params=batch)
+            lines.close()
+        db.query("""UPDATE words JOIN word_stems USING (wordid)
+                    SET words.stem = word_stems.stem""")
+        try:
+            db.query("""UPDATE wordsheap JOIN word_stems USING (wordid)
+                        SET wordsheap.stem = word_stems.stem""")
+        except MySQLdb.Error, e:
+            logging.debug("wordsheap stems not updated (%s): they are copied from words when it is next built" % e)
+        self.forget_memory_snapshot("wordsheap")
+        db.query("DROP TEMPORARY TABLE IF EXISTS word_stems")
+        db.conn.commit()
+        os.remove(path)
 
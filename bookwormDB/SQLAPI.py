@@ -418,7 +418,7 @@ class userquery:
         self.relevantTables = self.relevantTables.union(moreTables)
         self.catalog = "fastcat"
         for table in self.relevantTables:
-            if table!="fastcat" and table!="words" and table!="wordsheap" and table!="master_bookcounts" and table!="master_bigrams":
+            if table!="fastcat" and table!="words" and table!="wordsheap" and table!="master_bookcounts" and table!="master_bigrams" and table!="master_trigrams":
                 self.catalog = self.catalog + """ NATURAL JOIN """ + table + " "
 
     def make_catwhere(self):
@@ -427,7 +427,7 @@ class userquery:
         for key in self.limits.keys():
             # !!Warning--none of these phrases can be used in a bookworm as a custom table names.
             
-            if key not in ('word', 'word1', 'word2', 'hasword') and not re.search("words\d", key):
+            if key not in ('word', 'word1', 'word2', 'word3', 'hasword') and not re.search("words\d", key):
                 catlimits[key] = self.limits[key]
         if len(catlimits.keys()) > 0:
             self.catwhere = where_from_hash(catlimits)
@@ -497,12 +497,14 @@ class userquery:
     def make_wordwheres(self):
         self.wordswhere = " TRUE "
         self.max_word_length = 0
+        # The ids found for each position in a searched phrase, for `partition_where`.
+        self.wordidsSearched = dict()
         limits = []
         """
-        "unigram" or "bigram" can be used as an alias for "word" in the search_limits field.
+        "unigram", "bigram" or "trigram" can be used as an alias for "word" in the search_limits field.
         """
 
-        for gramterm in ['unigram', 'bigram']:
+        for gramterm in ['unigram', 'bigram', 'trigram']:
             if gramterm in self.limits.keys() and "word" not in self.limits.keys():
                 self.limits['word'] = self.limits[gramterm]
                 del self.limits[gramterm]
@@ -521,8 +523,8 @@ class userquery:
                     n += 1
                     searchingFor = word
                     if self.word_field == "stem":
-                        from nltk import PorterStemmer
-                        searchingFor = PorterStemmer().stem_word(searchingFor)
+                        import bookwormDB.stemming
+                        searchingFor = bookwormDB.stemming.stem(searchingFor)
                     if self.word_field == "case_insensitive" or self.word_field == "Case_Insensitive":
                         # That's a little joke. Get it?
                         searchingFor = searchingFor.lower()
@@ -537,6 +539,7 @@ class userquery:
                             locallimits['words'+str(n) + ".wordid"] += [wordid]
                         except KeyError:
                             locallimits['words'+str(n) + ".wordid"] = [wordid]
+                        self.wordidsSearched.setdefault(n, set()).add(int(wordid))
                     self.max_word_length = max(self.max_word_length, n)
 
                 # Strings have already been escaped, so don't need to be escaped again.
@@ -556,13 +559,15 @@ class userquery:
         limitlist = copy.deepcopy(self.limits.keys())
 
         for key in limitlist:
-            if re.search("words\d", key):
+            wordNumber = re.search("words(\d)", key)
+            if wordNumber:
                 wordlimits[key] = self.limits[key]
-                self.max_word_length = max(self.max_word_length, 2)
+                self.max_word_length = max(self.max_word_length, 2, int(wordNumber.group(1)))
                 del self.limits[key]
 
         if len(wordlimits.keys()) > 0:
             self.wordswhere = where_from_hash(wordlimits)
+            self.wordidsSearched = dict()
 
         return self.wordswhere
 
@@ -575,16 +580,32 @@ class userquery:
         We also now check for whether it needs the topic assignments: this could be generalized, with difficulty, for any other kind of plugin.
         """
 
+        needsTrigrams = (self.max_word_length == 3 or re.search("words3", self.selections))
         needsBigrams = (self.max_word_length == 2 or re.search("words2", self.selections))
         needsUnigrams = self.max_word_length == 1 or re.search("[^h][^a][^s]word", self.selections)
 
-        if self.max_word_length > 2:
+        if self.max_word_length > 3:
             err = dict(code=400, message="Phrase is longer than what Bookworm supports")
             raise BookwormException(err)
 
         needsTopics = bool(re.search("topic", self.selections)) or ("topic" in self.limits.keys())
 
-        if needsBigrams:
+        if needsTrigrams:
+
+            self.maintable = 'master_trigrams'
+
+            self.main = '''
+                 JOIN
+                 master_trigrams as main
+                 ON ('''+ self.prefs['fastcat'] +'''.bookid=main.bookid)
+                 '''
+
+            self.wordstables = """
+            JOIN %(wordsheap)s as words1 ON (main.word1 = words1.wordid)
+            JOIN %(wordsheap)s as words2 ON (main.word2 = words2.wordid)
+            JOIN %(wordsheap)s as words3 ON (main.word3 = words3.wordid) """ % self.__dict__
+
+        elif needsBigrams:
 
             self.maintable = 'master_bigrams'
 
@@ -652,6 +673,34 @@ class userquery:
             self.wordstables = " "
             self.wordswhere = " TRUE "
             # Just a dummy thing to make the SQL writing easier. Shouldn't take any time. Will usually be extended with actual conditions.
+            return
+
+        partitionwhere = self.partition_where()
+        if partitionwhere is not None and partitionwhere not in self.wordswhere:
+            self.wordswhere = "(" + self.wordswhere + " AND " + partitionwhere + ")"
+
+    def partition_where(self):
+        """
+        The ids of the searched words, as a condition on the counts table
+        itself rather than on the joined words tables. When the counts table
+        is partitioned by word id, MySQL can then read only the partitions
+        that hold those words instead of probing every one.
+        """
+        columns = {
+            'master_bookcounts': ["wordid"],
+            'master_bigrams': ["word1", "word2"],
+            'master_trigrams': ["word1", "word2", "word3"]
+            }.get(getattr(self, "maintable", None))
+        wordids = getattr(self, "wordidsSearched", dict())
+        if columns is None:
+            return None
+        terms = []
+        for (n, column) in enumerate(columns, 1):
+            if n in wordids:
+                terms.append("main.%s IN (%s)" % (column, ",".join(str(wordid) for wordid in sorted(wordids[n]))))
+        if len(terms) == 0:
+            return None
+        return " AND ".join(terms)
 
     def set_operations(self):
         """
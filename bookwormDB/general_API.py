@@ -152,7 +152,7 @@ def base_count_types(list_of_final_count_types):
 
 
 def is_a_wordcount_field(string):
-    if string in ["unigram", "bigram", "word"]:
+    if string in ["unigram", "bigram", "trigram", "word"]:
         return True
     return False
 
@@ -220,7 +220,7 @@ class APIcall(object):
         # Next, try deleting the word term.
 
         for word_term in search_limits.keys():
-            if word_term in ['word', 'unigram', 'bigram']:
+            if word_term in ['word', 'unigram', 'bigram', 'trigram']:
                 del compare_limits[word_term]
 
         # Finally, whether it's deleted a word term or not, return it all.
@@ -29,7 +29,7 @@ def main():
         writeWordIDs(args.unigrams)
     elif args.action == "encode":
         logging.debug("Starting feature encoding process")
-        encodePreTokenizedStream(args.unigrams,levels=["unigrams"])
+        encodeFeatureCounts(args.unigrams)
         #encodePreTokenizedStream(args.bigrams),levels=["bigrams"])
     else:
         logging.error("Need to specify action as either 'wordIds' or 'encode'")
@@ -37,29 +37,80 @@ def main():
 
 def writeWordIDs(featurefile, sep=None):
     """
-    The wordids are counted directly from the unigrams file.
+    The wordids are counted directly from the unigrams file, as by
+    `wordcounter.write_word_ids_from_feature_counts`.
 
     Filename: location of unigrams.txt
     sep: Delimiter. Defaults to None (whitespace), use this for tab- or 
             comma-delimiting. 
     """
-    
-    output = open(".bookworm/texts/wordlist/wordlist.txt","w")
-    wordcounts = dict()
-    for line in featurefile:
-        (bookid,word,count) = line.split(sep)
-        count = int(count)
-        try:
-            wordcounts[word] += count
-        except KeyError:
-            wordcounts[word] = count
-    tuples = [(v,k) for k,v in wordcounts.iteritems()]
-    tuples.sort()
-    tuples.reverse()
-    wordid = 0
-    for (count,word) in tuples:
-        wordid += 1
-        output.write("\t".join([str(wordid),word.replace("\\","\\\\"),str(count)]) + "\n")
+    from bookwormDB.wordcounter import write_word_ids_from_feature_counts
+    write_word_ids_from_feature_counts(featurefile, sep=sep)
+
+def encodeFeatureCounts(featurefile, format="text", chunkRows=2000000):
+    """
+    Encode a tab-separated "textid token count" feature file a chunk at a
+    time, rather than a line at a time as `encodePreTokenizedStream` does.
+
+    Each chunk's distinct filenames and tokens are looked up once apiece,
+    the ids are mapped onto the whole chunk at once, and the chunk is
+    written out in one go: as text, or packed when format is "binary".
+    Lines whose text or token isn't known are dropped, as before. Each
+    chunk's total for every text goes to the batch's nwords file, as
+    `tokenBatches.encodeRow` does.
+    """
+    import csv
+    import numpy as np
+    import pandas as pd
+    from bookwormDB.packedCounts import writeRecords, formatRecords
+
+    tokenBatch = tokenBatches(levels=["unigrams"], format=format)
+    tokenBatch.attachDictionaryAndID()
+    dictionary = tokenBatch.dictionary
+    IDfile = tokenBatch.IDfile
+    output = tokenBatch.outputFiles["unigrams"]
+
+    def lookup(table, keys):
+        if hasattr(table, "getMany"):
+            return table.getMany(keys)
+        found = dict()
+        for key in keys:
+            try:
+                found[key] = int(table[key])
+            except KeyError:
+                pass
+        return found
+
+    # Tokens are read exactly as written: no quoting, and "NA" or "null"
+    # are words, not missing values.
+    chunks = pd.read_csv(featurefile, sep="\t", header=None,
+                         names=["filename", "token", "count"],
+                         dtype={"filename": str, "token": str, "count": np.int64},
+                         quoting=csv.QUOTE_NONE, na_filter=False,
+                         chunksize=chunkRows)
+    rows = 0
+    written = 0
+    for chunk in chunks:
+        rows += len(chunk)
+        textids = chunk["filename"].map(lookup(IDfile, chunk["filename"].unique()))
+        wordids = chunk["token"].map(lookup(dictionary, chunk["token"].unique()))
+        keep = (textids.notnull() & wordids.notnull()).values
+        if not keep.any():
+            continue
+        records = np.column_stack([textids.values[keep], wordids.values[keep],
+                                   chunk["count"].values[keep]]).astype(np.int64)
+        if format == "binary":
+            writeRecords(output, records)
+        else:
+            output.write(formatRecords(records))
+        totals = pd.Series(records[:, 2]).groupby(records[:, 0]).sum()
+        for (textid, nwords) in totals.iteritems():
+            tokenBatch.nwords[int(textid)] = int(nwords)
+        tokenBatch.writeNwords()
+        written += len(records)
+        logging.debug("Encoded %d of %d feature counts so far" % (written, rows))
+    tokenBatch.flush()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+import mmap
+import os
+import struct
+import zlib
+import logging
+
+"""
+Compact, memory-mapped lookup tables from strings to integer ids.
+
+A python dict of a million words costs about 100 bytes an entry, and every
+process that needs one has to parse and build its own copy. These tables
+are written to disk once as flat arrays and opened with mmap: there is no
+parse step on opening, and every process reading the same file shares a
+single copy through the page cache.
+
+A table file is laid out as
+
+    header      8-byte magic string, then the number of entries (uint64)
+    hashes      uint64[n], sorted
+    values      uint32[n], in the same order as the hashes
+    offsets     uint64[n+1], into the string blob
+    strings     the utf-8 encoded keys, concatenated
+
+Lookups hash the key, binary search the hashes, and then compare the key
+against the stored string, so a hash collision can never return the
+wrong id.
+"""
+
+MAGIC = "BWTABLE1"
+HEADER = struct.Struct("<8sQ")
+
+
+def keyHash(key):
+    """
+    A 64-bit hash that, unlike `hash()`, is stable across processes and machines.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return ((zlib.crc32(key) & 0xffffffff) << 32) | (zlib.adler32(key) & 0xffffffff)
+
+
+def writeTable(path, items):
+    """
+    Write an iterable of (key, value) pairs to a table at `path`.
+
+    As with a dict, a key that appears more than once keeps its last value.
+    The file is written under a temporary name and moved into place, so
+    readers never see a half-built table.
+    """
+    import numpy as np
+
+    keys = []
+    values = []
+    for key, value in items:
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        keys.append(key)
+        values.append(value)
+
+    hashes = np.fromiter((keyHash(key) for key in keys), dtype="<u8", count=len(keys))
+    # A stable sort keeps duplicates in input order, so the last one wins below.
+    order = np.argsort(hashes, kind="mergesort")
+    hashes = hashes[order]
+
+    keep = np.ones(len(order), dtype=bool)
+    for i in np.nonzero(hashes[1:] == hashes[:-1])[0]:
+        # Equal hashes are rare; check for genuinely repeated keys.
+        for j in range(i + 1, len(order)):
+            if hashes[j] != hashes[i]:
+                break
+            if keys[order[i]] == keys[order[j]]:
+                keep[i] = False
+                break
+    order = order[keep]
+    hashes = hashes[keep]
+
+    sortedValues = np.array(values, dtype="<u4")[order]
+    lengths = np.fromiter((len(keys[i]) for i in order), dtype="<u8", count=len(order))
+    offsets = np.zeros(len(order) + 1, dtype="<u8")
+    np.cumsum(lengths, out=offsets[1:])
+
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    output = open(tmp, "wb")
+    output.write(HEADER.pack(MAGIC, len(order)))
+    hashes.tofile(output)
+    sortedValues.tofile(output)
+    if len(order) % 2:
+        # Keep the offsets 8-byte aligned.
+        output.write("\0" * 4)
+    offsets.tofile(output)
+    for i in order:
+        output.write(keys[i])
+    output.close()
+    os.rename(tmp, path)
+    logging.debug("Wrote %d keys to %s" % (len(order), path))
+
+
+class hashedTable(object):
+    """
+    A read-only, dict-like view of a table written by `writeTable`.
+
+    Values come back as integers.
+    """
+
+    def __init__(self, path):
+        import numpy as np
+
+        self.path = path
+        # Hashes are compared as numpy uint64s: a python long would be
+        # silently cast to a float.
+        self.uint64 = np.uint64
+        handle = open(path, "rb")
+        self.mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        handle.close()
+        (magic, n) = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise IOError("%s is not a bookworm lookup table" % path)
+        self.n = n
+        start = HEADER.size
+        self.hashes = np.frombuffer(self.mmap, dtype="<u8", count=n, offset=start)
+        start += 8 * n
+        self.values = np.frombuffer(self.mmap, dtype="<u4", count=n, offset=start)
+        start += 4 * n + 4 * (n % 2)
+        self.offsets = np.frombuffer(self.mmap, dtype="<u8", count=n + 1, offset=start)
+        self.blob = start + 8 * (n + 1)
+
+    def __len__(self):
+        return self.n
+
+    def key(self, i):
+        return self.mmap[self.blob + int(self.offsets[i]):self.blob + int(self.offsets[i + 1])]
+
+    def _find(self, key, h, i):
+        # i is the leftmost position of hash h in the sorted array.
+        while i < self.n and self.hashes[i] == h:
+            if self.key(i) == key:
+                return i
+            i += 1
+        return -1
+
+    def index(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        h = self.uint64(keyHash(key))
+        return self._find(key, h, int(self.hashes.searchsorted(h)))
+
+    def get(self, key, default=None):
+        i = self.index(key)
+        if i < 0:
+            return default
+        return int(self.values[i])
+
+    def __getitem__(self, key):
+        i = self.index(key)
+        if i < 0:
+            raise KeyError(key)
+        return int(self.values[i])
+
+    def __contains__(self, key):
+        return self.index(key) >= 0
+
+    def getMany(self, keys):
+        """
+        Look up a whole list of keys with a single vectorised search.
+        Returns a dict from each key that was found to its value.
+        """
+        import numpy as np
+
+        keys = list(keys)
+        encoded = [key.encode("utf-8") if isinstance(key, unicode) else key for key in keys]
+        hashes = np.fromiter((keyHash(key) for key in encoded), dtype="<u8", count=len(keys))
+        positions = self.hashes.searchsorted(hashes)
+        found = dict()
+        for key, encodedKey, h, i in zip(keys, encoded, hashes, positions):
+            i = self._find(encodedKey, h, int(i))
+            if i >= 0:
+                found[key] = int(self.values[i])
+        return found
@@ -6,16 +6,10 @@ dramatically reduces memory consumption for bookworms of over
 1 million documents.
 """
 
-import anydbm
-import os
+from bookwormDB.tokenizer import writeIDTable
 
 def text_id_dbm():
-    dbm = anydbm.open(".bookworm/texts/textids.dbm","c")
-    for file in os.listdir(".bookworm/texts/textids"):
-        for line in open(".bookworm/texts/textids/" + file):        
-            line = line.rstrip("\n")
-            splat = line.split("\t")
-            dbm[splat[1]] = splat[0]
+    writeIDTable()
 
 if __name__=="__main__":
     text_id_dbm()
@@ -87,10 +87,18 @@ class BookwormManager(object):
         if args.process=="encode":
             if args.feature_counts:
                 # Ideally the infile would be described by a specific file location here.
-                bookwormDB.tokenizer.encodePreTokenizedStream(infile=sys.stdin,levels=["unigrams"])
+                import bookwormDB.ingestFeatureCounts
+                bookwormDB.ingestFeatureCounts.encodeFeatureCounts(sys.stdin,format=args.format)
                 #bookwormDB.tokenizer.encodePreTokenizedStream(sys.stdin,levels=["bigrams"])
+            elif args.to_database:
+                import bookwormDB.CreateDatabase
+                source = "counts" if args.from_counts else "raw_text"
+                Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase()
+                Bookworm.stream_wordcounts(sys.stdin,processes=args.processes,levels=args.ngrams,source=source,
+                                           stem_processes=args.processes)
             else:
-                bookwormDB.tokenizer.encode_text_stream()
+                source = "counts" if args.from_counts else "raw_text"
+                bookwormDB.tokenizer.encode_text_stream(processes=args.processes,format=args.format,source=source,levels=args.ngrams)
             
         if args.process=="text_stream":
             if args.feature_counts:
@@ -134,6 +142,13 @@ class BookwormManager(object):
                 args.file = open(args.file)
             bookwormDB.tokenizer.print_token_stream(args.file,require_ids = require_id)
 
+        if args.process=="count_stream":
+            """
+            Like token_stream, but also saves each document's ngram counts
+            so that encoding doesn't have to tokenize everything again.
+            """
+            bookwormDB.tokenizer.count_stream(sys.stdin,levels=args.ngrams)
+
         if args.process=="word_db":
             import bookwormDB.wordcounter
             """
@@ -141,9 +156,28 @@ class BookwormManager(object):
             a words table.
             """
             if args.feature_counts:
-                bookwormDB.wordcounter.write_word_ids_from_feature_counts(sys.stdin)
+                input = sys.stdin if args.file is None else open(args.file)
+                bookwormDB.wordcounter.write_word_ids_from_feature_counts(input,shards=args.shards,processes=args.processes,tmpdir=args.temp_dir,
+                                                                          incremental=args.incremental,maxNewWords=args.max_new_words)
+            elif args.approximate:
+                if args.incremental:
+                    raise ValueError("--incremental needs exact counts, so can't be used with --approximate.")
+                recount = None
+                if args.exact_recount:
+                    if args.file is None:
+                        raise IOError("An exact recount reads the input twice, so it needs --file.")
+                    recount = lambda: open(args.file)
+                input = sys.stdin if args.file is None else open(args.file)
+                bookwormDB.wordcounter.WordsTableCreateApproximate(input,fromText=args.from_text,recount=recount)
+            elif args.shards > 1:
+                bookwormDB.wordcounter.WordsTableCreateSharded(sys.stdin,shards=args.shards,fromText=args.from_text,tmpdir=args.temp_dir,
+                                                               incremental=args.incremental,maxNewWords=args.max_new_words)
+            elif args.from_text:
+                bookwormDB.wordcounter.WordsTableCreateFromText(sys.stdin,processes=args.processes,tmpdir=args.temp_dir,
+                                                                incremental=args.incremental,maxNewWords=args.max_new_words)
             else:
-                bookwormDB.wordcounter.WordsTableCreate()
+                bookwormDB.wordcounter.WordsTableCreate(tmpdir=args.temp_dir,
+                                                        incremental=args.incremental,maxNewWords=args.max_new_words)
             
     def init(self,args):
         """
@@ -281,11 +315,51 @@ class BookwormManager(object):
     def text_id_database(self, **kwargs):
         """
         This function is defined in Create Database.
-        It builds a file at .bookworm/texts/textids.dbm
+        It builds a file at .bookworm/texts/textids.idx
         """
         import bookwormDB.CreateDatabase
         bookwormDB.CreateDatabase.text_id_dbm()
         
+    def wordlist_index(self, **kwargs):
+        """
+        Builds a memory-mapped lookup table for the wordlist at
+        .bookworm/texts/wordlist/wordlist.idx, which encoders share.
+        """
+        import bookwormDB.tokenizer
+        bookwormDB.tokenizer.writeDictionaryTable()
+
+    def update_words(self, **kwargs):
+        """
+        Applies the .bookworm/texts/wordlist/delta.txt written by an
+        incremental word_db to the words and wordsheap tables in place, and
+        stems the new words.
+        """
+        import bookwormDB.CreateDatabase
+        Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase()
+        previous = Bookworm.update_word_list()
+        Bookworm.update_Porter_stemming(since=previous)
+
+    def word_stems(self, cmd_args=None, **kwargs):
+        """
+        Fills in the Porter stems of any words in the words table that don't
+        have one yet, for 'All_Words_with_Same_Stem' searches.
+        """
+        import bookwormDB.CreateDatabase
+        processes = 1
+        if cmd_args:
+            processes = cmd_args.processes
+        Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase()
+        Bookworm.update_Porter_stemming(processes=processes)
+
+    def completed_index(self, **kwargs):
+        """
+        Checkpoints the list of already-encoded texts into an index at
+        .bookworm/texts/encoded/completed.idx, so the next encode (or a
+        resumed one) starts without rereading it. Don't run during an encode.
+        """
+        import bookwormDB.tokenizer
+        bookwormDB.tokenizer.completedIndex().checkpoint()
+
     def metadata(self, **kwargs):
         self.diskMetadata()
         self.preDatabaseMetadata()
@@ -332,7 +406,7 @@ class BookwormManager(object):
         for database in dbnames:
             logging.info("Reloading memory tables for %s" %database)
             Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(database,variableFile=None)
-            Bookworm.reloadMemoryTables(force=args.force)
+            Bookworm.reloadMemoryTables(force=args.force, workers=args.workers, snapshots=args.snapshots)
 
     def configuration(self,askk):
         import bookwormDB.configuration
@@ -389,8 +463,19 @@ class BookwormManager(object):
         reverse_index = True
         ingest = True
         newtable = True
+        bigram_reverse_index = False
+        table_count = 1
+        workers = 1
+        wordid_partitions = 0
+        append = False
+        stem_processes = 1
 
         if cmd_args:
+            append = cmd_args.append
+            stem_processes = cmd_args.stem_processes
+            table_count = cmd_args.table_count
+            workers = cmd_args.load_workers
+            wordid_partitions = cmd_args.wordid_partitions
             if cmd_args.index_only:
                 ingest = False
                 newtable = False
@@ -398,13 +483,34 @@ class BookwormManager(object):
                 index = not cmd_args.no_index
                 newtable = not cmd_args.no_delete
             reverse_index = not cmd_args.no_reverse_index
-            if not (newtable and ingest and index): 
-                logging.warn("database_wordcounts args not supported for bigrams yet.")
+            bigram_reverse_index = cmd_args.bigram_reverse_index
 
         Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase()
-        Bookworm.load_word_list()
-        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=reverse_index)
-        Bookworm.create_bigram_book_counts()
+        if cmd_args:
+            Bookworm.local_infile = not cmd_args.no_local_infile
+            Bookworm.insert_rows = cmd_args.insert_rows
+            Bookworm.verify_checksums = cmd_args.verify_checksums
+        if not append:
+            Bookworm.load_word_list()
+            if stem_processes > 0:
+                Bookworm.update_Porter_stemming(processes=stem_processes)
+        elif os.path.exists(".bookworm/texts/wordlist/delta.txt"):
+            # Only the words the new texts changed or added.
+            previous = Bookworm.update_word_list()
+            if stem_processes > 0:
+                Bookworm.update_Porter_stemming(processes=stem_processes, since=previous)
+        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=reverse_index,
+                                            table_count=table_count, workers=workers, wordid_partitions=wordid_partitions,
+                                            append=append)
+        Bookworm.create_bigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=bigram_reverse_index,
+                                           table_count=table_count, workers=workers, wordid_partitions=wordid_partitions,
+                                           append=append)
+        if append:
+            Bookworm.update_book_counts()
+        trigrams = ".bookworm/texts/encoded/trigrams"
+        if os.path.exists(trigrams) and len(os.listdir(trigrams)) > 0:
+            Bookworm.create_trigram_book_counts(newtable=newtable, ingest=ingest, index=index, table_count=table_count,
+                                                workers=workers, wordid_partitions=wordid_partitions, append=append)
 
     def database(self):
         self.database_wordcounts()
@@ -466,7 +572,7 @@ def run_arguments():
     parser.add_argument("--feature-counts",action="store_true",default=False,
                                  help="Use pre-calculated feature counts rather than tokenizing complete text on the fly. Off by default")
 
-    parser.add_argument("--ngrams",nargs="+",default=["unigrams","bigrams"],help="What levels to parse with. Multiple arguments should be unquoted in spaces. This option currently does nothing.")
+    parser.add_argument("--ngrams",nargs="+",default=["unigrams","bigrams"],choices=["unigrams","bigrams","trigrams"],help="What levels to parse with when encoding full text. Multiple arguments should be unquoted in spaces; add 'trigrams' to the default of 'unigrams bigrams' to build a trigram table as well.")
 
     
     # Use subparsers to have an action syntax, like git.
@@ -516,6 +622,13 @@ def run_arguments():
                                       changed. Good for maintenance, bad for actively updated\
                                       installations.")
     memory_tables_parser.set_defaults(force=False)
+    memory_tables_parser.add_argument("--workers",type=int,default=1,
+                                      help="Rebuild this many tables at once, each over its own connection. A table\
+                                      still waits for the table it depends on. Default 1.")
+    memory_tables_parser.add_argument("--snapshots",action="store_true",default=False,
+                                      help="Restore each table from the on-disk copy saved when it was last built,\
+                                      if that is still current, and save a copy of any table built from scratch.\
+                                      Much faster after a restart. --force-reload rebuilds from scratch and retakes them.")
     memory_tables_parser.add_argument("--all",action="store_true",default=False,
                                       help="Search for all bookworm installations on\
                                       the server, and reload memory tables for each of them.")
@@ -537,6 +650,14 @@ def run_arguments():
     tokenization_subparsers = tokenization_parser.add_subparsers(title="process",help='The part of the subparser to run: see help for more details.',dest="process")
     encode_parser = tokenization_subparsers.add_parser("encode",
                                      help="Encode according to the stored numeric IDs.")
+    encode_parser.add_argument("--processes","-p",type=int,default=1,
+                               help="Encode in a pool of this many worker processes that share a single copy of the dictionary, rather than relying on GNU parallel to split the input. Default 1.")
+    encode_parser.add_argument("--format",choices=["text","binary"],default="text",
+                               help="Write encoded counts as tab-separated text, or as packed binary records that are much cheaper to write and are streamed into MySQL at load time. Default text.")
+    encode_parser.add_argument("--from-counts",action="store_true",default=False,
+                               help="Read the count shards written by count_stream from stdin instead of raw text, so nothing is tokenized twice.")
+    encode_parser.add_argument("--to-database",action="store_true",default=False,
+                               help="Stream the counts through named pipes straight into freshly created MySQL count tables instead of writing encoded files. Loads (and stems) the words table too. Always a full rebuild; --format is ignored.")
     text_stream_parser = tokenization_subparsers.add_parser("text_stream",
                                                             help="Print text from various sources to stdout in a standard form.")
     text_stream_parser.add_argument("--file","-f",help="location of a formatted input file: leave blank for sensible defaults as described in the documentation.",default=None)
@@ -549,7 +670,28 @@ def run_arguments():
         help="A file to tokenize. By default, reads the output of text_stream from stdin.",
         default=None)
 
+    count_stream_parser = tokenization_subparsers.add_parser("count_stream",
+        help="Tokenize bookworm-formatted text from stdin once: print the tokens, as token_stream does, and save each document's ngram counts to .bookworm/texts/counts for 'encode --from-counts'.")
+
     word_db_parser = tokenization_subparsers.add_parser("word_db",help="Turn a list of tokens into a sorted set of number IDs, even if there are more distinct types than can fit in memory, by writing to disk.")
+    word_db_parser.add_argument("--from-text",action="store_true",default=False,
+                                help="Read bookworm-formatted text from stdin (the output of text_stream) and tokenize it here, instead of reading the output of token_stream.")
+    word_db_parser.add_argument("--processes","-p",type=int,default=1,
+                                help="With --from-text or --feature-counts, count in a pool of this many worker processes. Default 1.")
+    word_db_parser.add_argument("--shards",type=int,default=1,
+                                help="Count in this many processes, each handling its own part of the vocabulary when the counts are merged. Works with or without --from-text. Default 1.")
+    word_db_parser.add_argument("--approximate",action="store_true",default=False,
+                                help="Find the most common words with a fixed-size heavy-hitter summary instead of counting every distinct string exactly. Much less memory for corpora with a long tail of junk.")
+    word_db_parser.add_argument("--exact-recount",action="store_true",default=False,
+                                help="With --approximate, make a second pass to count the candidate words exactly. Requires --file.")
+    word_db_parser.add_argument("--file","-f",default=None,
+                                help="Read the input from this file rather than stdin.")
+    word_db_parser.add_argument("--temp-dir",default=None,
+                                help="Where to write the sorted runs of counts that don't fit in memory. Default .bookworm/texts/wordlist/runs.")
+    word_db_parser.add_argument("--incremental",action="store_true",default=False,
+                                help="Add the counts from the input (just the new texts) to the existing wordlist.txt instead of rebuilding it. Old words keep their ids; new words are numbered after them. Writes wordlist/delta.txt for 'bookworm prep update_words'.")
+    word_db_parser.add_argument("--max-new-words",type=int,default=None,
+                                help="With --incremental, the most new words to add. Default: as many as fit under the dictionary size.")
     ########## Build components
     extensions_parser = subparsers.add_parser("prep", help="Build individual components: primarily used by the Makefile.")
     extensions_subparsers = extensions_parser.add_subparsers(title="goal", help="The name of the target.", dest="goal")
@@ -564,9 +706,21 @@ def run_arguments():
     word_ingest_parser.add_argument("--no-delete", action="store_true", help="Do not delete and rebuild the token tables. Useful for a partially finished ingest.")
     word_ingest_parser.add_argument("--no-reverse-index", action="store_true", help="When creating the table, choose not to index bookid/wordid/counts. This is useful for really large builds. Because this is specified at table creation time, it does nothing with --no-delete or --index-only.")
     word_ingest_parser.add_argument("--no-index", action="store_true", help="Do not re-enable keys after ingesting tokens. Only do this if you intent to manually enable keys or will run this command again.")
+    word_ingest_parser.add_argument("--append", action="store_true", help="Keep the existing count tables and load only the encoded files that aren't yet in their manifest (loaded_count_files), then recompute nwords and fastcat for just the books in those files. The words table is not reloaded: wordlist/delta.txt, if there is one, is applied and its new words stemmed. Implies --no-delete.")
+    word_ingest_parser.add_argument("--verify-checksums", action="store_true", help="With --append, also read every file already in the manifest and compare its md5 with the one recorded by the last verified append, instead of trusting its size and modification time. Slow on large corpora.")
     word_ingest_parser.add_argument("--index-only", action="store_true", help="Only re-enable keys. Supercedes other flags.")
+    word_ingest_parser.add_argument("--no-local-infile", action="store_true", help="Don't try LOAD DATA LOCAL INFILE for the counts (for servers that forbid it): insert them directly with multi-row INSERTs instead. Also happens automatically if the server refuses the first load.")
+    word_ingest_parser.add_argument("--insert-rows", type=int, default=5000, help="Rows per INSERT statement when inserting directly. Default 5000.")
+    word_ingest_parser.add_argument("--bigram-reverse-index", action="store_true", help="Also index the bigram table by bookid first. Off by default, since bigram tables are so large; like --no-reverse-index, only applies at table creation.")
+    word_ingest_parser.add_argument("--stem-processes", type=int, default=1, help="Porter-stem the wordlist (for 'All_Words_with_Same_Stem' searches) in this many processes. 0 skips stemming. Default 1.")
+    word_ingest_parser.add_argument("--table-count", type=int, default=1, help="Split the unigram and bigram counts across this many tables each (master_bookcounts_p1...pN, master_bigrams_p1...pN), joined by MERGE tables. Default 1.")
+    word_ingest_parser.add_argument("--wordid-partitions", type=int, default=0, help="Instead, partition master_bookcounts and master_bigrams natively by ranges of wordid (of the first word, for bigrams), so that a search reads only the partition holding its word. Default 0 (unpartitioned).")
+    word_ingest_parser.add_argument("--load-workers", type=int, default=1, help="Load this many of those tables at once, each over its own MySQL connection. Default 1.")
+    stem_parser = extensions_subparsers.add_parser("word_stems",
+                                                   help=getattr(BookwormManager, "word_stems").__doc__)
+    stem_parser.add_argument("--processes", "-p", type=int, default=1, help="Stem in this many processes. Default 1.")
     # Bookworm prep targets that don't allow additional args
-    for prep_arg in ['text_id_database', 'catalog_metadata', 'database_metadata', 'guessAtFieldDescriptions']:
+    for prep_arg in ['text_id_database', 'wordlist_index', 'update_words', 'completed_index', 'catalog_metadata', 'database_metadata', 'guessAtFieldDescriptions']:
         extensions_subparsers.add_parser(prep_arg, help=getattr(BookwormManager, prep_arg).__doc__)
 
     """
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+import os
+import threading
+import logging
+
+"""
+A packed binary alternative to the tab-separated encoded count files.
+
+Formatting every count as text costs most of the encoding time, and MySQL
+then has to parse it all back again. A packed file is just a run of
+fixed-width records of little-endian uint32s, with no header:
+
+    unigrams    bookid, wordid, count
+    bigrams     bookid, word1, word2, count
+    trigrams    bookid, word1, word2, word3, count
+
+so files can be appended to or concatenated freely. They are written with a
+`.bin` suffix next to the `.txt` files in `.bookworm/texts/encoded/<level>`.
+
+MySQL can't read them directly: `textPipe` streams one through a named pipe
+as text, so `LOAD DATA LOCAL INFILE` reads it without the text ever
+touching the disk.
+"""
+
+DTYPE = "<u4"
+SUFFIX = ".bin"
+NGRAM_LENGTHS = {"unigrams": 1, "bigrams": 2, "trigrams": 3}
+
+
+def recordWidth(level):
+    """
+    The number of uint32 fields in each record for an ngram level.
+    """
+    return NGRAM_LENGTHS[level] + 2
+
+
+def writeRecords(output, values):
+    """
+    Append a flat list of record fields to an open file.
+    """
+    import numpy as np
+    np.array(values, dtype=DTYPE).tofile(output)
+
+
+def readRecords(path, width, chunkRows=1000000):
+    """
+    Yield an (n, width) array for each block of up to `chunkRows` records.
+    """
+    import numpy as np
+    input = open(path, "rb")
+    try:
+        while True:
+            chunk = np.fromfile(input, dtype=DTYPE, count=chunkRows * width)
+            if len(chunk) == 0:
+                break
+            if len(chunk) % width:
+                logging.warning("%s ends with a partial record: ignoring the last %d values" % (path, len(chunk) % width))
+                chunk = chunk[:len(chunk) - len(chunk) % width]
+            yield chunk.reshape(-1, width)
+    finally:
+        input.close()
+
+
+def formatRecords(records):
+    """
+    Tab-separated text for an (n, width) array of records, one per line.
+
+    The whole array is formatted in a single operation rather than row by row.
+    """
+    line = "\t".join(["%d"] * records.shape[1]) + "\n"
+    return (line * len(records)) % tuple(records.ravel().tolist())
+
+
+def writeAsText(path, width, output, chunkRows=1000000):
+    """
+    Write a packed file out as tab-separated text, one record per line.
+    """
+    for records in readRecords(path, width, chunkRows):
+        output.write(formatRecords(records))
+
+
+class textPipe(object):
+    """
+    A named pipe that a background thread fills with the text form of a
+    packed file, or of any other iterable of (n, width) `records` arrays
+    read from `source`.
+
+    Use as a context manager around the `LOAD DATA LOCAL INFILE` that reads
+    `self.path`. On leaving, the writer is unblocked if nothing ever opened
+    the pipe, and any error it hit is raised.
+    """
+
+    def __init__(self, source, width, directory, records=None):
+        self.source = source
+        self.width = width
+        if records is None:
+            records = readRecords(source, width)
+        self.records = records
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, "%s.%d.fifo" % (os.path.basename(source), os.getpid()))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+        self.opened = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        try:
+            # Blocks until MySQL opens the other end.
+            output = open(self.path, "wb")
+            self.opened.set()
+            try:
+                for records in self.records:
+                    output.write(formatRecords(records))
+            finally:
+                output.close()
+        except Exception, e:
+            self.error = e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while not self.opened.is_set() and self.thread.is_alive():
+            # The load failed before it read anything: the writer is
+            # still waiting for a reader, so be one and hang up.
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self.opened.wait(0.1)
+            os.close(fd)
+        self.thread.join()
+        os.remove(self.path)
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
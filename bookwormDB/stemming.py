@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+import re
+import logging
+
+"""
+Porter stems for the wordlist and for searched words.
+
+The stem column of `words` is filled in bulk (see
+`BookwormSQLDatabase.update_Porter_stemming`): stems are computed here,
+across a pool of processes, and written to a file that MySQL loads in one
+go. Searches stem their words with the same function, which shares a
+single stemmer and remembers the stems it has already worked out.
+"""
+
+STEMMABLE = re.compile(r"^[A-Za-z]+$")
+
+_stemmer = None
+_memo = dict()
+
+
+def stem(word):
+    """
+    The Porter stem of `word`, from a stemmer shared by every call.
+    """
+    global _stemmer
+    try:
+        return _memo[word]
+    except KeyError:
+        pass
+    if _stemmer is None:
+        from nltk import PorterStemmer
+        _stemmer = PorterStemmer()
+    if len(_memo) >= 100000:
+        _memo.clear()
+    _memo[word] = _stemmer.stem(word)
+    return _memo[word]
+
+
+def wordStem(word):
+    """
+    The stem stored for a word in the wordlist, or None for words that
+    aren't stemmed. Possessives have the same stem as the word without
+    them; anything else not purely alphabetic is left alone.
+    """
+    if not STEMMABLE.match(word.replace("'s", "")):
+        return None
+    return stem(word)
+
+
+def _stemBatch(rows):
+    """
+    Tab-separated "wordid\tstem" lines for a list of (wordid, word) rows.
+    """
+    output = []
+    for (wordid, word) in rows:
+        stemmed = wordStem(word)
+        if stemmed is not None:
+            output.append("%d\t%s\n" % (wordid, stemmed))
+    return "".join(output)
+
+
+def writeStems(rows, output, processes=1, batchSize=10000):
+    """
+    Writes "wordid\tstem" lines to the open file `output` for each
+    stemmable word in an iterable of (wordid, word) rows, stemming in a
+    pool of `processes` workers if that is more than 1. Returns the number
+    of stems written.
+    """
+    import itertools
+    rows = iter(rows)
+    batches = iter(lambda: list(itertools.islice(rows, batchSize)), [])
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap(_stemBatch, batches)
+            written = _writeAll(results, output)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        written = _writeAll(itertools.imap(_stemBatch, batches), output)
+    logging.info("Wrote %d stems" % written)
+    return written
+
+
+def _writeAll(results, output):
+    written = 0
+    for text in results:
+        output.write(text)
+        written += text.count("\n")
+    return written
@@ -6,6 +6,9 @@ import os
 import anydbm
 import time
 import logging
+from collections import defaultdict
+from itertools import izip, islice
+from bookwormDB.packedCounts import NGRAM_LENGTHS
 
 """
 This section does a lot of work on tokenizing and aggregating wordcounts.
@@ -51,9 +54,71 @@ def readDictionaryFile(prefix=""):
         look[splat[1]] = splat[0]
     return look
 
+def readDictionaryTable(prefix=""):
+    """
+    Opens the memory-mapped version of the wordlist at
+    `.bookworm/texts/wordlist/wordlist.idx`, building it first if it is
+    missing or older than wordlist.txt. Unlike `readDictionaryFile`, there's
+    no per-process parsing, and every encoder shares the same pages.
+    """
+    from bookwormDB.lookupTables import hashedTable
+    wordlist = prefix + ".bookworm/texts/wordlist/wordlist.txt"
+    index = prefix + ".bookworm/texts/wordlist/wordlist.idx"
+    if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(wordlist):
+        writeDictionaryTable(prefix)
+    return hashedTable(index)
+
+def writeDictionaryTable(prefix=""):
+    from bookwormDB.lookupTables import writeTable
+    def entries():
+        for line in open(prefix + ".bookworm/texts/wordlist/wordlist.txt"):
+            splat = line.rstrip("\n").split("\t")
+            yield (splat[1], int(splat[0]))
+    writeTable(prefix + ".bookworm/texts/wordlist/wordlist.idx", entries())
+
 def readIDfile(prefix=""):
+    """
+    Opens the lookup from filenames to bookids: the memory-mapped table at
+    `.bookworm/texts/textids.idx` if it has been built, or else the older
+    dbm file.
+    """
+    index = prefix + ".bookworm/texts/textids.idx"
+    if os.path.exists(index):
+        from bookwormDB.lookupTables import hashedTable
+        return hashedTable(index)
     return anydbm.open(prefix + ".bookworm/texts/textids.dbm")
 
+def writeIDTable(prefix=""):
+    """
+    Builds `.bookworm/texts/textids.idx` from the `bookid\tfilename` lists in
+    `.bookworm/texts/textids` in a single bulk write, rather than a
+    dbm insert for every text.
+    """
+    from bookwormDB.lookupTables import writeTable
+    folder = prefix + ".bookworm/texts/textids/"
+    def entries():
+        for file in os.listdir(folder):
+            for line in open(folder + file):
+                line = line.rstrip("\n")
+                if line=="":
+                    # It's OK to have a blank line, let's say.
+                    continue
+                splat = line.split("\t")
+                yield (splat[1], int(splat[0]))
+    writeTable(prefix + ".bookworm/texts/textids.idx", entries())
+
+def IDfileIsForkSafe(prefix=""):
+    """
+    The memory-mapped table is read-only, so forked children can share it.
+    Of the dbms, dumbdbm keeps its whole index in memory and reopens the data file on every
+    lookup, so a handle can be shared with forked children. The C-backed dbms
+    share a file offset between processes and have to be reopened in each one.
+    """
+    if os.path.exists(prefix + ".bookworm/texts/textids.idx"):
+        return True
+    import whichdb
+    return whichdb.whichdb(prefix + ".bookworm/texts/textids.dbm") == "dumbdbm"
+
 class tokenBatches(object):
     """
     A tokenBatches is a manager for tokenizers. Each one corresponds to 
@@ -66,24 +131,101 @@ class tokenBatches(object):
 
     It also has a method that encodes and writes its wordcounts into a tsv file appropriate for reading with mysql,
     with 3-byte integer encoding for wordid and bookid.
+
+    With format="binary", the counts are written instead as packed uint32 records
+    (see `bookwormDB.packedCounts`), which skips formatting every number as text.
+
+    `outputFiles` can map each level to an already open file (a pipe, say) to
+    write to instead. Nothing is then recorded as completed.
+
+    Alongside the counts, each batch writes the total of its encoded unigram
+    counts for every text, "bookid\tnwords" a line, to
+    `.bookworm/texts/encoded/nwords/<id>.txt` (or to `nwordsFile`, with
+    `outputFiles`), so the nwords table can be loaded without summing
+    master_bookcounts. A text spread over several rows can have several
+    lines: they add up.
     """
     
-    def __init__(self,levels=["unigrams","bigrams"]):
+    def __init__(self,levels=["unigrams","bigrams"],format="text",outputFiles=None,nwordsFile=None):
         self.id = '%030x' % random.randrange(16**30)
         self.levels=levels
+        self.format=format
+        self.nwords = dict()
+
+        if outputFiles is not None:
+            self.outputFiles = outputFiles
+            self.completedFile = None
+            self.nwordsFile = nwordsFile
+            return
+
+        if format=="binary":
+            from bookwormDB.packedCounts import SUFFIX
+            suffix = SUFFIX
+            mode = "wb"
+        else:
+            suffix = ".txt"
+            mode = "w"
 
         self.completedFile = open(".bookworm/texts/encoded/completed/" + self.id,"w")
+        self.nwordsFile = None
+        if "unigrams" in levels:
+            nwordsDir = ".bookworm/texts/encoded/nwords"
+            try:
+                os.makedirs(nwordsDir)
+            except OSError:
+                if not os.path.isdir(nwordsDir):
+                    raise
+            self.nwordsFile = open(nwordsDir + "/" + self.id + ".txt","w")
         self.outputFiles = dict()
         for level in levels:
-            self.outputFiles[level] = open(".bookworm/texts/encoded/" + level + "/" + self.id + ".txt","w")
+            self.outputFiles[level] = open(".bookworm/texts/encoded/" + level + "/" + self.id + suffix,mode)
 
     def attachDictionaryAndID(self):
-        self.dictionary = readDictionaryFile()
+        self.dictionary = readDictionaryTable()
         self.IDfile = readIDfile()
 
+    def flush(self):
+        """
+        Push everything written so far to disk. Pool workers exit without
+        closing their files, so they call this after each batch.
+        """
+        for outputFile in self.outputFiles.values():
+            outputFile.flush()
+        if self.completedFile is not None:
+            self.completedFile.flush()
+        if self.nwordsFile is not None:
+            self.nwordsFile.flush()
+
+    def writeNwords(self):
+        """
+        Write out the word totals gathered since the last call.
+        """
+        if self.nwordsFile is not None and len(self.nwords) > 0:
+            self.nwordsFile.write("".join(["%s\t%d\n" % pair for pair in self.nwords.iteritems()]))
+        self.nwords = dict()
+
+    def encodeRows(self, rows, source="raw_text", write_completed=True):
+        """
+        Encode a list of rows, looking up all of their text ids at once when
+        the id file is a memory-mapped table.
+        """
+        IDfile = self.IDfile
+        if not hasattr(IDfile, "getMany"):
+            for row in rows:
+                self.encodeRow(row, source=source, write_completed=write_completed)
+            self.writeNwords()
+            return
+        self.IDfile = IDfile.getMany(set(row.split("\t",1)[0] for row in rows))
+        try:
+            for row in rows:
+                self.encodeRow(row, source=source, write_completed=write_completed)
+        finally:
+            self.IDfile = IDfile
+        self.writeNwords()
+
     def encodeRow(self,
                   row,
-                  source="raw_text", # Can also be "countfile", in which case each row is a tab separated list of [filename,ngram,count], where ngrams can contain spaces.
+                  source="raw_text", # Can also be "countfile", in which case each row is a tab separated list of [filename,ngram,count], where ngrams can contain spaces; or "counts", a row of a count shard written by `count_stream`.
                   write_completed=True
     ):
 
@@ -108,8 +250,12 @@ class tokenBatches(object):
                 raise
             tokens = preTokenized(token,count,self.levels[0])
 
+        if source=="counts":
+            tokens = shardCounts(row)
+            filename = tokens.filename
+
         try:
-            textid = IDfile[filename]
+            textid = str(IDfile[filename])
         except KeyError:
             if source=="raw_text":
                 logging.warn("Warning: file " + filename + " not found in jsoncatalog.txt, not encoding")
@@ -119,12 +265,34 @@ class tokenBatches(object):
                 pass
             return
 
-        for level in self.levels:
+        counted = countLevels(tokens, self.levels)
+        levelCounts = [(level, counted[level]) for level in self.levels]
+
+        if hasattr(dictionary, "getMany"):
+            # A memory-mapped dictionary: resolve every distinct word
+            # in the row with one vectorised search.
+            words = set()
+            for (level, counts) in levelCounts:
+                for wordset in counts:
+                    words.update(wordset)
+            if self.format=="binary":
+                dictionary = dictionary.getMany(words)
+            else:
+                dictionary = dict((word, str(wordid)) for (word, wordid) in dictionary.getMany(words).iteritems())
+
+        if self.format=="binary":
+            nwords = self.writePackedCounts(textid, levelCounts, dictionary)
+            if "unigrams" in self.levels:
+                self.nwords[textid] = self.nwords.get(textid, 0) + nwords
+            if write_completed:
+                self.completedFile.write(filename + "\n")
+            return
+
+        nwords = 0
+        for (level, counts) in levelCounts:
             outputFile = self.outputFiles[level]
             output = []
 
-            counts = tokens.counts(level)
-
             for wordset,count in counts.iteritems():
                 skip = False
                 wordList = []
@@ -146,6 +314,8 @@ class tokenBatches(object):
                 if not skip:
                     wordids = "\t".join(wordList)
                     output.append("\t".join([textid,wordids,str(count)]))
+                    if level == "unigrams":
+                        nwords += int(count)
 
             try:
                 if len(output) > 0:
@@ -155,9 +325,44 @@ class tokenBatches(object):
             except IOError, e:
                 logging.exception(e)
 
+        if "unigrams" in self.levels:
+            self.nwords[textid] = self.nwords.get(textid, 0) + nwords
         if write_completed:
             self.completedFile.write(filename + "\n")
 
+    def writePackedCounts(self, textid, levelCounts, dictionary):
+        """
+        The binary counterpart to the text output in `encodeRow`: each ngram
+        whose words are all in the dictionary becomes one packed record.
+        Returns the total of the unigram counts written.
+        """
+        from bookwormDB.packedCounts import writeRecords
+        textid = int(textid)
+        nwords = 0
+        for (level, counts) in levelCounts:
+            values = []
+            for wordset,count in counts.iteritems():
+                record = [textid]
+                for word in wordset:
+                    try:
+                        record.append(int(dictionary[word]))
+                    except KeyError:
+                        try:
+                            record.append(int(dictionary[word.encode("utf-8")]))
+                        except KeyError:
+                            break
+                else:
+                    record.append(int(count))
+                    values.extend(record)
+                    if level == "unigrams":
+                        nwords += int(count)
+            if len(values) > 0:
+                try:
+                    writeRecords(self.outputFiles[level], values)
+                except IOError, e:
+                    logging.exception(e)
+        return nwords
+
 class tokenizer(object):
     """
     A tokenizer is initialized with a single text string.
@@ -212,10 +417,11 @@ class tokenizer(object):
     def ngrams(self,n):
         """
         All the ngrams in the text can be created as a tuple by zipping an arbitrary number of
-        copies of the text to itself.
+        copies of the text to itself. The copies are offset iterators rather than slices,
+        so for a long text nothing the length of the token list is built.
         """
         self.tokenize()
-        return zip(*[self.tokens[i:] for i in range(n)])
+        return izip(*[islice(self.tokens,i,None) for i in range(n)])
 
     def unigrams(self):
         return self.ngrams(1)
@@ -227,14 +433,62 @@ class tokenizer(object):
         return self.ngrams(3)
 
     def counts(self,whichType):
-        count = dict()
+        count = defaultdict(int)
+        if whichType=="unigrams":
+            # Counting the bare strings builds one tuple per word type, not per token.
+            for token in self.tokenize():
+                count[token] += 1
+            return dict(((token,),n) for (token,n) in count.iteritems())
         for gram in getattr(self,whichType)():
-            try:
-                count[gram] += 1
-            except KeyError:
-                count[gram] = 1
+            count[gram] += 1
+        # Behave like a plain dict from here on: missing keys raise KeyError.
+        count.default_factory = None
         return count
 
+    def countLevels(self,levels):
+        """
+        The counts for several levels at once, as `counts` returns them for
+        each, from a single pass that slides a window of the last two words
+        along the tokens. Returns a dict from each level to its counts.
+        """
+        tokens = self.tokenize()
+        longest = max(NGRAM_LENGTHS[level] for level in levels)
+        if longest == 1:
+            return dict((level,self.counts(level)) for level in levels)
+        unigrams = defaultdict(int)
+        bigrams = defaultdict(int)
+        trigrams = defaultdict(int)
+        for token in tokens[:2]:
+            unigrams[token] += 1
+        if len(tokens) >= 2:
+            (a,b) = tokens[:2]
+            bigrams[(a,b)] += 1
+            if longest == 2:
+                for c in islice(tokens,2,None):
+                    unigrams[c] += 1
+                    bigrams[(b,c)] += 1
+                    b = c
+            else:
+                for c in islice(tokens,2,None):
+                    unigrams[c] += 1
+                    bigrams[(b,c)] += 1
+                    trigrams[(a,b,c)] += 1
+                    (a,b) = (b,c)
+        bigrams.default_factory = None
+        trigrams.default_factory = None
+        output = {"bigrams":bigrams,"trigrams":trigrams}
+        output["unigrams"] = dict(((token,),n) for (token,n) in unigrams.iteritems())
+        return dict((level,output[level]) for level in levels)
+
+def countLevels(tokens,levels):
+    """
+    A dict from each level to the counts from `tokens`: in one pass for a
+    `tokenizer`, or a level at a time for the objects that stand in for one.
+    """
+    if hasattr(tokens,"countLevels"):
+        return tokens.countLevels(levels)
+    return dict((level,tokens.counts(level)) for level in levels)
+
 
 class preTokenized(object):
     """
@@ -253,6 +507,78 @@ class preTokenized(object):
         return self.output
 
     
+class shardCounts(object):
+    """
+    The ngram counts for one document, read back from a line of a count
+    shard written by `count_stream`. Like `preTokenized`, it stands in for
+    a tokenizer, so encoding never has to run the regex again.
+
+    A line is the filename, then one tab-separated field per level like
+    `bigrams=of the 12 the cat 1`: space-separated words, each ngram
+    followed by its count.
+    """
+
+    def __init__(self,row):
+        fields = row.split("\t")
+        self.filename = fields[0]
+        self.fields = dict()
+        for field in fields[1:]:
+            (level,entries) = field.split("=",1)
+            self.fields[level] = entries
+
+    def counts(self,level):
+        n = NGRAM_LENGTHS[level]
+        items = self.fields[level].split(" ")
+        output = dict()
+        for i in xrange(0,len(items)-n,n+1):
+            output[tuple(items[i:i+n])] = items[i+n]
+        return output
+
+def formatShardRow(filename,tokens,levels):
+    """
+    The inverse of `shardCounts`. Ngrams with a word containing a tab,
+    newline or space are dropped: they would break the line apart, and
+    could never be in the wordlist anyway.
+    """
+    fields = [filename]
+    counted = countLevels(tokens,levels)
+    for level in levels:
+        entries = []
+        for gram,count in counted[level].iteritems():
+            if any(u"\t" in word or u"\n" in word or u" " in word for word in gram):
+                continue
+            entries.append(u" ".join(gram))
+            entries.append(unicode(count))
+        fields.append(level + "=" + u" ".join(entries).encode("utf-8"))
+    return "\t".join(fields)
+
+def encodedNwordsFiles(directory=".bookworm/texts/encoded"):
+    """
+    The word-total files written by the encoder in `directory`/nwords, or
+    None if there aren't any or if some unigram count file has none to go
+    with it (one encoded before they were written, say), since the books in
+    it would be missed.
+    """
+    from bookwormDB.packedCounts import SUFFIX
+    nwordsDir = os.path.join(directory, "nwords")
+    if not os.path.isdir(nwordsDir):
+        return None
+    files = sorted(filename for filename in os.listdir(nwordsDir) if filename.endswith(".txt"))
+    if len(files) == 0:
+        return None
+    ids = set(filename[:-len(".txt")] for filename in files)
+    unigrams = os.path.join(directory, "unigrams")
+    if os.path.isdir(unigrams):
+        for filename in os.listdir(unigrams):
+            (id, suffix) = os.path.splitext(filename)
+            # Only the count files themselves: not the pipes directory
+            # that packed files are streamed through, say.
+            if suffix not in (".txt", SUFFIX) or not os.path.isfile(os.path.join(unigrams, filename)):
+                continue
+            if id not in ids:
+                return None
+    return [os.path.join(nwordsDir, filename) for filename in files]
+
 def getAlreadySeenList(folder):
     #Load in a list of what's already been translated for that level.
     #Returns a set.
@@ -263,18 +589,248 @@ def getAlreadySeenList(folder):
             seen.add(line.rstrip("\n"))
     return seen
 
-def encode_text_stream():
-    seen = getAlreadySeenList(".bookworm/texts/encoded/completed")
-    tokenBatch = tokenBatches()
+class completedIndex(object):
+    """
+    The set of documents that have already been encoded.
+
+    Every encoder appends the names of the documents it finishes to its own
+    file in `folder`. Rather than reading all of those at startup, most of
+    them are kept in a memory-mapped table at `<folder>.idx`, and a manifest
+    next to it records how far into each file the table goes: only the
+    lines written since the last `checkpoint` have to be read.
+    """
+
+    def __init__(self, folder=".bookworm/texts/encoded/completed"):
+        from bookwormDB.lookupTables import hashedTable
+        self.folder = folder
+        self.path = folder + ".idx"
+        self.manifest = self.path + ".manifest"
+        self.table = None
+        self.offsets = dict()
+        if os.path.exists(self.path) and os.path.exists(self.manifest):
+            self.table = hashedTable(self.path)
+            for line in open(self.manifest):
+                (name, offset) = line.rstrip("\n").split("\t")
+                self.offsets[name] = int(offset)
+        self.recent = set()
+        self.recentOffsets = dict()
+        for name in os.listdir(folder):
+            start = self.offsets.get(name, 0)
+            handle = open(folder + "/" + name)
+            handle.seek(start)
+            data = handle.read()
+            handle.close()
+            # A line without its newline may still be being written.
+            end = data.rfind("\n") + 1
+            if end > 0:
+                self.recent.update(data[:end - 1].split("\n"))
+            self.recentOffsets[name] = start + end
+        logging.debug("%d completed documents indexed, %d more read from the completed files" % (len(self.table) if self.table is not None else 0, len(self.recent)))
+
+    def __contains__(self, filename):
+        if filename in self.recent:
+            return True
+        return self.table is not None and filename in self.table
+
+    def checkpoint(self):
+        """
+        Fold the recently completed documents into the table. This shouldn't
+        run while other encoders are finishing documents.
+        """
+        from bookwormDB.lookupTables import writeTable, hashedTable
+        def entries():
+            if self.table is not None:
+                for i in xrange(len(self.table)):
+                    yield (self.table.key(i), 1)
+            for filename in self.recent:
+                yield (filename, 1)
+        writeTable(self.path, entries())
+        self.offsets.update(self.recentOffsets)
+        tmp = "%s.tmp%d" % (self.manifest, os.getpid())
+        output = open(tmp, "w")
+        for (name, offset) in self.offsets.iteritems():
+            output.write("%s\t%d\n" % (name, offset))
+        output.close()
+        # Written after the table, so that the manifest never claims more than it holds.
+        os.rename(tmp, self.manifest)
+        self.table = hashedTable(self.path)
+        self.recent = set()
+        self.recentOffsets = dict()
+
+def encode_text_stream(processes=1, batchSize=4*1024*1024, format="text", source="raw_text", levels=["unigrams","bigrams"]):
+    """
+    Encode a stream of bookworm-formatted text from stdin.
+
+    With processes > 1, the dictionary and ID file are opened once here and
+    a pool of forked workers shares them; rows are handed out
+    in batches of roughly `batchSize` bytes. Each worker writes its own
+    output files, just like the separate processes under `parallel --pipe`.
+
+    format is "text" for tab-separated counts or "binary" for packed records.
+    source is "raw_text" for bookworm-formatted text, or "counts" for the
+    lines of count shards already written by `count_stream`.
+    """
+    seen = completedIndex()
+    if processes > 1:
+        rows = (line.rstrip("\n") for line in sys.stdin if line.split("\t",1)[0] not in seen)
+        encode_rows_in_pool(rows, processes=processes, levels=levels, batchSize=batchSize, format=format, source=source)
+        # Nothing else is encoding now, so it's safe to checkpoint.
+        completedIndex().checkpoint()
+        return
+    tokenBatch = tokenBatches(levels=levels, format=format)
     tokenBatch.attachDictionaryAndID()
-    for line in sys.stdin:
-        filename = line.split("\t",1)[0]
-        line = line.rstrip("\n")
-        if filename not in seen:
-            tokenBatch.encodeRow(line)
+    rows = (line.rstrip("\n") for line in sys.stdin if line.split("\t",1)[0] not in seen)
+    for batch in _batches(rows, batchSize):
+        tokenBatch.encodeRows(batch, source=source)
             
     #And printout again at the end
 
+# State shared with the forked encoding workers. The parent fills it before
+# the pool is created, so nothing here is pickled or reopened per worker.
+_shared = dict()
+_workerBatch = None
+_workerSource = "raw_text"
+
+def _init_encoding_worker(levels, format, source, buffered=False):
+    global _workerBatch, _workerSource
+    _workerSource = source
+    # Buffered workers hand their output back rather than opening files.
+    _workerBatch = tokenBatches(levels=levels, format=format, outputFiles=dict() if buffered else None)
+    _workerBatch.dictionary = _shared["dictionary"]
+    if _shared["IDfile"] is not None:
+        _workerBatch.IDfile = _shared["IDfile"]
+    else:
+        _workerBatch.IDfile = readIDfile()
+
+def _encode_batch(rows):
+    # Exceptions are handed back as text: in python 2 a failed apply_async
+    # never runs its callback, which would leave the parent waiting forever.
+    try:
+        _workerBatch.encodeRows(rows, source=_workerSource)
+        _workerBatch.flush()
+    except Exception:
+        import traceback
+        return traceback.format_exc()
+    return None
+
+def _batches(rows, batchSize):
+    batch = []
+    size = 0
+    for row in rows:
+        batch.append(row)
+        size += len(row)
+        if size >= batchSize:
+            yield batch
+            batch = []
+            size = 0
+    if len(batch) > 0:
+        yield batch
+
+def encode_rows_in_pool(rows, processes, levels=["unigrams","bigrams"], batchSize=4*1024*1024, format="text", source="raw_text"):
+    """
+    Encode an iterable of raw text (or count shard) rows across a pool of `processes` workers.
+
+    Only a few batches per worker are ever in flight, so memory stays bounded
+    no matter how fast the input can be read.
+    """
+    import multiprocessing
+    import threading
+
+    start = time.time()
+    _shared["dictionary"] = readDictionaryTable()
+    _shared["IDfile"] = readIDfile() if IDfileIsForkSafe() else None
+    logging.info("Dictionary attached once for %d workers (%d s)" % (processes, int(time.time() - start)))
+
+    pool = multiprocessing.Pool(processes, initializer=_init_encoding_worker, initargs=(levels, format, source))
+    inFlight = threading.BoundedSemaphore(processes*2)
+    errors = []
+
+    def finished(error):
+        if error is not None:
+            errors.append(error)
+        inFlight.release()
+
+    try:
+        for batch in _batches(rows, batchSize):
+            inFlight.acquire()
+            if len(errors) > 0:
+                break
+            pool.apply_async(_encode_batch, (batch,), callback=finished)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    if len(errors) > 0:
+        logging.error(errors[0])
+        raise RuntimeError("%d encoding batches failed" % len(errors))
+    logging.info("Pool encoding finished (%d s)" % int(time.time() - start))
+
+def _encode_batch_as_text(rows):
+    """
+    Encode a batch in a pool worker, and hand the text for each level back
+    to the parent instead of writing it. Returns (error, outputs).
+    """
+    import cStringIO
+    try:
+        _workerBatch.outputFiles = dict((level, cStringIO.StringIO()) for level in _workerBatch.levels)
+        _workerBatch.nwordsFile = cStringIO.StringIO()
+        _workerBatch.encodeRows(rows, source=_workerSource, write_completed=False)
+        outputs = dict((level, output.getvalue()) for (level, output) in _workerBatch.outputFiles.iteritems())
+        return (None, outputs, _workerBatch.nwordsFile.getvalue())
+    except Exception:
+        import traceback
+        return (traceback.format_exc(), None, None)
+
+def encode_rows_to_files(rows, outputFiles, processes=1, levels=["unigrams","bigrams"], batchSize=4*1024*1024, source="raw_text",
+                         nwordsFile=None):
+    """
+    Encode an iterable of rows as text counts written straight to
+    `outputFiles`, a dict of open files for each level: named pipes that
+    MySQL is loading from, for instance. Nothing is recorded as completed.
+    The word totals for each text go to `nwordsFile`, if given.
+
+    With processes > 1, a pool of workers encodes the batches and this
+    process does all the writing, so that lines from different workers
+    never interleave. Only a few batches per worker are in flight at once.
+    """
+    if processes <= 1:
+        tokenBatch = tokenBatches(levels=levels, outputFiles=outputFiles, nwordsFile=nwordsFile)
+        tokenBatch.attachDictionaryAndID()
+        for batch in _batches(rows, batchSize):
+            tokenBatch.encodeRows(batch, source=source, write_completed=False)
+        return
+
+    import multiprocessing
+    import collections
+    _shared["dictionary"] = readDictionaryTable()
+    _shared["IDfile"] = readIDfile() if IDfileIsForkSafe() else None
+    pool = multiprocessing.Pool(processes, initializer=_init_encoding_worker, initargs=(levels, "text", source, True))
+    pending = collections.deque()
+
+    def write(result):
+        (error, outputs, nwords) = result.get()
+        if error is not None:
+            logging.error(error)
+            raise RuntimeError("An encoding batch failed")
+        for (level, text) in outputs.iteritems():
+            outputFiles[level].write(text)
+        if nwordsFile is not None:
+            nwordsFile.write(nwords)
+
+    try:
+        for batch in _batches(rows, batchSize):
+            pending.append(pool.apply_async(_encode_batch_as_text, (batch,)))
+            while len(pending) >= 2*processes:
+                write(pending.popleft())
+        while len(pending) > 0:
+            write(pending.popleft())
+        pool.close()
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+
 def print_token_stream(input,regex=None,require_ids=True):
     """
     Reads text files as input; tokenizes and separates by spaces.
@@ -302,7 +858,31 @@ def print_token_stream(input,regex=None,require_ids=True):
         print out.encode("utf-8")
     
 
-def encodePreTokenizedStream(infile,levels=["unigrams"]):
+def count_stream(input,levels=["unigrams","bigrams"]):
+    """
+    Tokenizes bookworm-formatted text once, for both halves of the build.
+
+    Like `print_token_stream`, it prints the tokens of every document for
+    `word_db` to count; but it also writes each document's ngram counts to a
+    shard at `.bookworm/texts/counts/<id>.txt`. Once the wordlist exists,
+    `encode_text_stream(source="counts")` translates those shards directly.
+    """
+    shardid = '%030x' % random.randrange(16**30)
+    shard = open(".bookworm/texts/counts/" + shardid + ".txt","w")
+    for row in input:
+        parts = row.rstrip("\n").split("\t",1)
+        try:
+            tokens = tokenizer(parts[1])
+        except IndexError:
+            logging.warning("Found no tab in the input for row starting with\n" +
+                            row[:50] + "\n...skipping row")
+            continue
+        shard.write(formatShardRow(parts[0],tokens,levels) + "\n")
+        out = u" ".join(tokens.tokenize())
+        print out.encode("utf-8")
+    shard.close()
+
+def encodePreTokenizedStream(infile,levels=["unigrams"],format="text"):
     """
     Note: since unigrams and bigrams are done separately, we have to just redo the whole
     thing every time. The prebuilt list don't work.
@@ -310,13 +890,12 @@ def encodePreTokenizedStream(infile,levels=["unigrams"]):
     Infile can be an open stream or a file.
     """
     start = time.time()
-    tokenBatch = tokenBatches(levels=levels)
+    tokenBatch = tokenBatches(levels=levels,format=format)
     tokenBatch.attachDictionaryAndID()
     logging.debug("Token batch attached (%d s)" % int(time.time() - start))
-    for line in infile:
-        filename = line.split("\t",1)[0]
-        line = line.rstrip("\n")
-        tokenBatch.encodeRow(line,source="countfile", write_completed=False)
+    rows = (line.rstrip("\n") for line in infile)
+    for batch in _batches(rows, 4*1024*1024):
+        tokenBatch.encodeRows(batch, source="countfile", write_completed=False)
 
 
 if __name__=="__main__":
@@ -831,16 +831,75 @@ class variableSet:
             self.db.query('DELETE FROM masterTableTable WHERE masterTableTable.tablename="%s";' %self.fastName)
             self.db.query("INSERT INTO masterTableTable VALUES ('%s','%s','%s')" % (self.fastName,parentTab,escape_string(fileCommand)))
     
-    def createNwordsFile(self):
+    def createNwordsFile(self, bookids=None, local_infile=True, insert_rows=5000):
         """
         A necessary supplement to the `catalog` table.
+
+        The totals for books not yet in `nwords` are loaded from the files
+        the encoder writes alongside the counts (see `encodedNwordsFiles`)
+        when there is one for everything encoded; otherwise they are summed
+        from master_bookcounts, which means reading the whole table.
+
+        After an append, `bookids` are the books in the files it loaded: just
+        their totals are summed again from master_bookcounts, whether they
+        are new or have gained counts.
+
+        The files are read with LOAD DATA LOCAL INFILE unless `local_infile`
+        is False or the server refuses it, in which case their rows are
+        inserted `insert_rows` at a time.
         """
         db = self.db
 
         db.query("CREATE TABLE IF NOT EXISTS nwords (bookid MEDIUMINT UNSIGNED, PRIMARY KEY (bookid), nwords INT);")
+        if bookids is not None:
+            logging.info("Summing nwords for the %d books with new counts" % len(bookids))
+            bookids = sorted(bookids)
+            for start in xrange(0, len(bookids), 1000):
+                db.query("REPLACE INTO nwords (bookid,nwords) SELECT bookid,SUM(count) FROM master_bookcounts "
+                         "WHERE bookid IN (%s) GROUP BY bookid" % ",".join(str(bookid) for bookid in bookids[start:start + 1000]))
+        else:
+            from bookwormDB.tokenizer import encodedNwordsFiles
+            files = encodedNwordsFiles()
+            if files is None:
+                logging.info("Summing nwords from master_bookcounts")
+                db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN master_bookcounts USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid")
+            else:
+                self.loadEncodedNwords(files, local_infile, insert_rows)
         db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
-        db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN master_bookcounts USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid")
-        db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
+
+    def loadEncodedNwords(self, files, local_infile=True, insert_rows=5000):
+        """
+        Adds the totals in the encoder's nwords files for books not yet in
+        `nwords`, as for `createNwordsFile`.
+        """
+        db = self.db
+        from bookwormDB.CreateDatabase import bulk_insert, insert_statements_from_text
+        logging.info("Loading nwords from %d files written while encoding" % len(files))
+        # Not a TEMPORARY table: a reconnect would silently drop that.
+        db.query("DROP TABLE IF EXISTS nwords_encoded")
+        db.query("CREATE TABLE nwords_encoded (bookid MEDIUMINT UNSIGNED, nwords INT UNSIGNED)")
+        try:
+            for filename in files:
+                if local_infile:
+                    try:
+                        db.query("LOAD DATA LOCAL INFILE '%s' INTO TABLE nwords_encoded (bookid,nwords)" % filename)
+                        continue
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception, e:
+                        logging.warning("Couldn't LOAD DATA from %s (%s): inserting the rows directly instead" % (filename, e))
+                        local_infile = False
+                input = open(filename)
+                try:
+                    bulk_insert(db, insert_statements_from_text(input, "nwords_encoded", ["bookid","nwords"], insert_rows))
+                finally:
+                    input.close()
+            db.query("""INSERT INTO nwords (bookid,nwords)
+                        SELECT encoded.bookid,SUM(encoded.nwords) FROM nwords_encoded AS encoded
+                        LEFT JOIN nwords USING (bookid) WHERE nwords.bookid IS NULL GROUP BY encoded.bookid""")
+        finally:
+            db.query("DROP TABLE IF EXISTS nwords_encoded")
+
 
 
 
@@ -1,55 +1,118 @@
 #!/usr/bin/python
 
 from tokenizer import *
+from tokenizer import _batches
+from collections import defaultdict
 import sys
-import subprocess
+import os
+import heapq
+import tempfile
 import timeit
+import zlib
+import itertools
 
 
-def write_word_ids_from_feature_counts(featurefile, sep=None):
+class sortedRuns(object):
     """
-    The wordids are counted directly from the unigrams file.
+    The words spilled to disk while counting, as a set of run files in
+    `directory` (by default `.bookworm/texts/wordlist/runs`), each one
+    sorted by word. Merging them streams through every run at once, so
+    totalling the counts takes one pass and memory for one line per run.
 
-    Filename: location of unigrams.txt
-    sep: Delimiter. Defaults to None (whitespace), use this for tab- or 
-            comma-delimiting. 
+    A count that is starting opens its runs with `fresh`, which throws away
+    any left in the directory by one that died before merging them: they
+    would otherwise be counted again.
     """
-    
-    output = open(".bookworm/texts/wordlist/wordlist.txt","w")
-    wordcounts = dict()
-    for line in featurefile:
-        (bookid,word,count) = line.split(sep)
-        count = int(count)
+
+    def __init__(self, directory=None, fresh=False):
+        if directory is None:
+            directory = ".bookworm/texts/wordlist/runs"
+        self.directory = directory
         try:
-            wordcounts[word] += count
-        except KeyError:
-            wordcounts[word] = count
-    tuples = [(v,k) for k,v in wordcounts.iteritems()]
-    tuples.sort()
-    tuples.reverse()
-    wordid = 0
-    for (count,word) in tuples:
-        wordid += 1
-        output.write("\t".join([str(wordid),word.replace("\\","\\\\"),str(count)]) + "\n")
-
-        
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        if fresh and len(self.paths()) > 0:
+            logging.warning("Removing %d runs left in %s by an unfinished count" % (len(self.paths()), directory))
+            self.clear()
+
+    def writeRun(self, items):
+        """
+        Write an iterable of (word, count) pairs as a new run.
+        """
+        (fd, path) = tempfile.mkstemp(prefix="run.", dir=self.directory)
+        output = os.fdopen(fd, "w")
+        for (word, count) in sorted(items):
+            output.write(word + " " + str(count) + "\n")
+        output.close()
+
+    def paths(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.startswith("run.")]
+
+    def readRun(self, path):
+        for line in open(path):
+            (word, count) = line.rstrip("\n").rsplit(" ", 1)
+            yield (word, int(count))
+
+    def merged(self):
+        """
+        Yield every word once, in sorted order, with its total count.
+        """
+        last = None
+        total = 0
+        for (word, count) in heapq.merge(*[self.readRun(path) for path in self.paths()]):
+            if word != last:
+                if last is not None:
+                    yield (last, total)
+                last = word
+                total = 0
+            total += count
+        if last is not None:
+            yield (last, total)
+
+    def clear(self):
+        for path in self.paths():
+            os.remove(path)
+
+class shardedRuns(object):
+    """
+    Sorted runs split into `shards` subdirectories of `directory` by a hash
+    of the word, so that each shard holds a disjoint part of the vocabulary
+    and can be merged on its own.
+    """
+
+    def __init__(self, directory, shards, fresh=False):
+        self.shards = [sortedRuns(os.path.join(directory, "shard%d" % i), fresh=fresh) for i in range(shards)]
+
+    def writeRun(self, items):
+        parts = [[] for shard in self.shards]
+        for (word, count) in items:
+            parts[zlib.crc32(word) % len(parts)].append((word, count))
+        for (shard, part) in zip(self.shards, parts):
+            if len(part) > 0:
+                shard.writeRun(part)
+
 def exportToDisk(wordcounts,diskFile,keepThreshold=5):
     """
     Periodically, the wordcounter writes what it knows to disk for dictionary values below a certain frequency:
     this lets us keep the most common words continually in memory, and only write out (say) 'the' once, at the end.
+
+    diskFile is a `sortedRuns` (or `shardedRuns`): each export is written as a single sorted run.
     """
     commonwords = dict()
+    spilled = []
     for key in wordcounts.iterkeys():
         if wordcounts[key] < keepThreshold:
-            key = key
-            output = key + " " + str(wordcounts[key]) + "\n"
-            diskFile.write(output)
+            spilled.append((key, wordcounts[key]))
         else:
             commonwords[key] = wordcounts[key]
-    return commonwords
+    diskFile.writeRun(spilled)
     logging.info("export done")
+    return commonwords
     
-def WordsTableCreate(maxDictionaryLength=1000000, maxMemoryStorage=20000000):
+def WordsTableCreate(maxDictionaryLength=1000000, maxMemoryStorage=20000000, tmpdir=None,
+                     incremental=False, maxNewWords=None):
     """
     This function reads already-tokenized words from sys.stdin,
     and uses them to count all the words in the document.
@@ -60,8 +123,13 @@ def WordsTableCreate(maxDictionaryLength=1000000, maxMemoryStorage=20000000):
     It does this by maintaining a dictionary in memory, and periodically 
     writing the least used portions of that to disk; once it's read everything,
     it writes everything to disk, sorts the list of all words so that 
+    the most common ones get the lowest ids.
+
+    The spilled counts go to sorted run files in `tmpdir`. With
+    `incremental`, they are added to the existing wordlist: see
+    `mergeIntoWordlist`.
     """
-    database = open('.bookworm/texts/wordlist/raw.txt','w')
+    database = sortedRuns(tmpdir, fresh=True)
     start_time = timeit.default_timer()
     n = 1
     #When flushing the dictionary to disk, they are kept in memory if there count is
@@ -82,48 +150,140 @@ def WordsTableCreate(maxDictionaryLength=1000000, maxMemoryStorage=20000000):
             except KeyError:
                 wordcounts[item] = 1
 
-            while len(wordcounts) > maxMemoryStorage:
-                logging.info("exporting to disk at " + str(float(len(wordcounts))/1000000) + " million words")
-                wordcounts = exportToDisk(wordcounts,diskFile=database,keepThreshold=keepThreshold)
-                logging.info("after export, it's " + str(float(len(wordcounts))/1000000) + " million words")
-                if len(wordcounts) > .8*float(maxMemoryStorage):
-                    #If that's not enough to get down to a small dictionary,
-                    #try again with a new higher limit.
-                    keepThreshold = keepThreshold*2
-                    logging.info("upping the keep threshold to " + str(keepThreshold))
+            (wordcounts, keepThreshold) = spillToDisk(wordcounts, database, keepThreshold, maxMemoryStorage)
 
     #Write all remaining items to disk
     nothing = exportToDisk(wordcounts,diskFile=database,keepThreshold=float("inf"))
-    database.close()
-    sortWordlist(maxDictionaryLength=maxDictionaryLength)
+    sortWordlist(maxDictionaryLength=maxDictionaryLength, tmpdir=tmpdir,
+                 incremental=incremental, maxNewWords=maxNewWords)
 
-def sortWordlist(maxDictionaryLength=1000000):
+def spillToDisk(wordcounts, database, keepThreshold, maxMemoryStorage):
     """
-    The function to sort and curtail the wordcounts created by the previous function leaves an unsorted file at
-    `.bookworm/texts/wordlist/raw.txt`. We sort this by invoking the system "sort" program, which is likely to be 
-    faster than anything pythonic; and then for legacy reasons use a perl program to make the counts, sort again (to put the most common words
-    at the top, and then take the top 1,000,000 words.
+    Writes the rarer words out to disk until the dictionary fits in `maxMemoryStorage`.
+    Returns the new dictionary and the (possibly raised) keepThreshold.
+    """
+    while len(wordcounts) > maxMemoryStorage:
+        logging.info("exporting to disk at " + str(float(len(wordcounts))/1000000) + " million words")
+        wordcounts = exportToDisk(wordcounts,diskFile=database,keepThreshold=keepThreshold)
+        logging.info("after export, it's " + str(float(len(wordcounts))/1000000) + " million words")
+        if len(wordcounts) > .8*float(maxMemoryStorage):
+            #If that's not enough to get down to a small dictionary,
+            #try again with a new higher limit.
+            keepThreshold = keepThreshold*2
+            logging.info("upping the keep threshold to " + str(keepThreshold))
+    return (wordcounts, keepThreshold)
+
+def countTextBatch(rows):
+    """
+    Tokenizes a list of bookworm-formatted rows and returns the counts of
+    their words, utf-8 encoded. Tokens containing tabs or newlines are
+    skipped, since they can't be written to the wordlist.
+    """
+    counts = defaultdict(int)
+    for row in rows:
+        parts = row.rstrip("\n").split("\t",1)
+        if len(parts) < 2:
+            logging.warning("Found no tab in the input for row starting with\n" +
+                            row[:50] + "\n...skipping row")
+            continue
+        for token in tokenizer(parts[1]).tokenize():
+            counts[token] += 1
+    return dict((token.encode("utf-8"), count) for (token, count) in counts.iteritems()
+                if u"\t" not in token and u"\n" not in token)
+
+def WordsTableCreateFromText(input, processes=1, batchSize=4*1024*1024,
+                             maxDictionaryLength=1000000, maxMemoryStorage=20000000, tmpdir=None,
+                             incremental=False, maxNewWords=None, counter=None, keepOldIds=True):
+    """
+    Like `WordsTableCreate`, but reads bookworm-formatted text rather than a
+    token stream, and tokenizes it here: nothing is printed as text only to
+    be read back in and split again. (`counter` replaces `countTextBatch`
+    for other kinds of input; `keepOldIds` is as for `writeWordlist`.)
+
+    With processes > 1, a pool of workers each count a batch of rows at a
+    time, and their partial counts are merged here, spilling to disk just as
+    `WordsTableCreate` does.
+    """
+    import collections
+    if counter is None:
+        counter = countTextBatch
+    database = sortedRuns(tmpdir, fresh=True)
+    keepThreshold = 2
+    wordcounts = dict()
+    start_time = timeit.default_timer()
+
+    def merge(partial):
+        for (word, count) in partial.iteritems():
+            try:
+                wordcounts[word] += count
+            except KeyError:
+                wordcounts[word] = count
+
+    batches = _batches(input, batchSize)
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(counter, (batch,)))
+                # Only a few batches per worker are ever waiting to be merged.
+                while len(pending) >= 2*processes:
+                    merge(pending.popleft().get())
+                    (wordcounts, keepThreshold) = spillToDisk(wordcounts, database, keepThreshold, maxMemoryStorage)
+            while len(pending) > 0:
+                merge(pending.popleft().get())
+                (wordcounts, keepThreshold) = spillToDisk(wordcounts, database, keepThreshold, maxMemoryStorage)
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+    else:
+        for batch in batches:
+            merge(counter(batch))
+            (wordcounts, keepThreshold) = spillToDisk(wordcounts, database, keepThreshold, maxMemoryStorage)
+    logging.info("%d distinct words counted in %d seconds" % (len(wordcounts), int(timeit.default_timer() - start_time)))
+
+    exportToDisk(wordcounts,diskFile=database,keepThreshold=float("inf"))
+    sortWordlist(maxDictionaryLength=maxDictionaryLength, tmpdir=tmpdir,
+                 incremental=incremental, maxNewWords=maxNewWords, keepOldIds=keepOldIds)
+
+def sortWordlist(maxDictionaryLength=1000000, tmpdir=None, incremental=False, maxNewWords=None, keepOldIds=True):
+    """
+    The counting functions above leave their counts in sorted runs in `tmpdir`.
+    These are merged in a single streaming pass that totals each word's count,
+    keeping only the top `maxDictionaryLength` words as it goes; those
+    then get ids, with the most common words first.
+
+    With `incremental`, the counts are instead added to the existing
+    wordlist by `mergeIntoWordlist`.
+    """
+    logging.info("Merging and collapsing word counts\n")
+    runs = sortedRuns(tmpdir)
+    if incremental:
+        mergeIntoWordlist(runs.merged(), maxDictionaryLength=maxDictionaryLength, maxNewWords=maxNewWords)
+        runs.clear()
+        return
+    top = topWords(runs.merged(), maxDictionaryLength)
+    runs.clear()
+    writeWordlist(top, maxDictionaryLength=maxDictionaryLength, keepOldIds=keepOldIds)
+
+def topWords(counts, n):
+    """
+    The n most common of an iterable of (word, count) pairs, most common first.
+    Ties are broken by reverse byte order, as `sort -nrk2` did under LC_ALL=C.
+    """
+    return heapq.nlargest(n, counts, key=lambda pair: (pair[1], pair[0]))
+
+def writeWordlist(top, maxDictionaryLength=1000000, keepOldIds=True):
+    """
+    Give ids to a list of (word, count) pairs, most common first, and write
+    them to `.bookworm/texts/wordlist/wordlist.txt`. Words already in an
+    existing wordlist keep their old ids, and an existing wordlist that is
+    already full is left as it is; with keepOldIds=False, it is ignored and
+    replaced.
     """
-    logging.info("Sorting full word counts\n")
-    #This LC_COLLATE here seems to be extremely necessary, because otherwise alphabetical order isn't preserved across different orderings.
-    subprocess.call(["export LC_COLLATE='C';export LC_ALL='C'; sort -k1 .bookworm/texts/wordlist/raw.txt > .bookworm/texts/wordlist/sorted.txt"], shell=True)
-    
-    logging.info("Collapsing word counts\n")
-    
-    #This is in perl, using bignum, because it's possible to get integer overflows on a really huge text set (like Google ngrams).
-
-    subprocess.call(["""
-           perl -ne '
-           BEGIN {use bignum; $last=""; $count=0} 
-           if ($_ =~ m/(.*) (\d+)/) {
-            if ($last ne $1 & $last ne "") {
-             print "$last $count\n"; $count = 0;
-            } 
-           $last = $1;
-           $count += $2
-           } END {print "$last $count\n"}' .bookworm/texts/wordlist/sorted.txt > .bookworm/texts/wordlist/counts.txt"""], shell=True) 
-
-    subprocess.call(["export LC_ALL='C';export LC_COLLATE='C';sort -nrk2 .bookworm/texts/wordlist/counts.txt > .bookworm/texts/wordlist/complete.txt"], shell=True)
     # logfile.write("Including the old words first\n")
     oldids = set()
     oldids.add(0)
@@ -133,53 +293,352 @@ def sortWordlist(maxDictionaryLength=1000000):
     This following section may be fixed for unicode problems
     """
 
-    try:
-        i = 1
-        oldFile = open(".bookworm/texts/wordlist/wordlist.txt")
-        for line in oldFile:
-            line = line.split('\t')
-            wid = int(line[0])
-            word = line[1]
-            oldids.add(wid)
-            oldwords[word] = wid
-            i = i + 1
-            if i > maxDictionaryLength:
-                oldFile.close()
-                return
-        oldFile.close()
+    if keepOldIds:
+        try:
+            i = 1
+            oldFile = open(".bookworm/texts/wordlist/wordlist.txt")
+            for line in oldFile:
+                line = line.split('\t')
+                wid = int(line[0])
+                word = line[1]
+                oldids.add(wid)
+                oldwords[word] = wid
+                i = i + 1
+                if i > maxDictionaryLength:
+                    oldFile.close()
+                    return
+            oldFile.close()
 
-    #To work perfectly, this would have to keep track of all the words that have been added, and also update the database with the counts from the old books for each of them. That's hard. Currently, a new word will be added if the new set of texts AND the old one has it in its top 1m words; BUT it will be only added into the database among the new texts, not the old ones. In a few cases that defeats the point of updating the old list at all, since we can't see the origins, but at least new people will show up eventually.
-    except:
-        # logfile.write(" No original file to work from: moving on...\n")
-        pass
+        #To work perfectly, this would have to keep track of all the words that have been added, and also update the database with the counts from the old books for each of them. That's hard. Currently, a new word will be added if the new set of texts AND the old one has it in its top 1m words; BUT it will be only added into the database among the new texts, not the old ones. In a few cases that defeats the point of updating the old list at all, since we can't see the origins, but at least new people will show up eventually.
+        except:
+            # logfile.write(" No original file to work from: moving on...\n")
+            pass
     newWords = set()
     # logfile.write("writing new ids\n")
-    newlist = open(".bookworm/texts/wordlist/complete.txt","r")
-    i = 1
     nextIDtoAssign = max(oldids) + 1
     counts = list()
-    for line in newlist:
-        line = line.split(" ")
-        word = line[0]
-        count = line[1]
+    for (word, count) in top:
         try:
             wordid = oldwords[word]
         except KeyError:
             wordid = nextIDtoAssign
             nextIDtoAssign = nextIDtoAssign+1
-        counts.append("\t".join([str(wordid), word.replace("\\","\\\\"), count]))
-            
-        i = i + 1
-        if i > maxDictionaryLength:
-            break
+        counts.append("\t".join([str(wordid), word.replace("\\","\\\\"), str(count)]) + "\n")
 
     output = open(".bookworm/texts/wordlist/newwordlist.txt", "w")
     for count in counts:
-        output.write(count) #Should just carry over the newlines from earlier.
+        output.write(count)
+    output.close()
     
     #Don't overwrite the new file until the old one is complete
-    subprocess.call(["mv", ".bookworm/texts/wordlist/newwordlist.txt", ".bookworm/texts/wordlist/wordlist.txt"])
+    os.rename(".bookworm/texts/wordlist/newwordlist.txt", ".bookworm/texts/wordlist/wordlist.txt")
+
+def mergeIntoWordlist(counts, maxDictionaryLength=1000000, maxNewWords=None):
+    """
+    Add the counts from a new batch of texts to the existing
+    `.bookworm/texts/wordlist/wordlist.txt`, rather than rebuilding it.
+
+    `counts` is an iterable of (word, count) pairs, each word once, as from
+    `sortedRuns.merged`. Every word already in the list keeps its id and has
+    the new count added to its old one. New words are ranked among
+    themselves and the top `maxNewWords` (by default, as many as fit under
+    maxDictionaryLength) are given ids after the highest existing one.
+
+    Every changed or added entry is also written, in the wordlist's own
+    format, to `.bookworm/texts/wordlist/delta.txt`, which
+    `BookwormSQLDatabase.update_word_list` applies to the words tables in
+    place. Returns the number of new words.
+    """
+    entries = []
+    index = dict()
+    try:
+        for line in open(".bookworm/texts/wordlist/wordlist.txt"):
+            (wordid, word, count) = line.rstrip("\n").split("\t")
+            word = word.replace("\\\\", "\\")
+            index[word] = len(entries)
+            entries.append([int(wordid), word, int(count)])
+    except IOError:
+        logging.warning("No existing wordlist to add to: starting a new one")
+    if maxNewWords is None:
+        maxNewWords = max(0, maxDictionaryLength - len(entries))
+
+    changed = []
+    def unseen():
+        for (word, count) in counts:
+            try:
+                i = index[word]
+            except KeyError:
+                yield (word, count)
+                continue
+            entries[i][2] += count
+            changed.append(i)
+
+    if maxNewWords > 0:
+        top = topWords(unseen(), maxNewWords)
+    else:
+        # Still have to read everything to update the old counts.
+        top = []
+        for pair in unseen():
+            pass
+
+    nextIDtoAssign = max([0] + [entry[0] for entry in entries]) + 1
+    added = []
+    for (word, count) in top:
+        added.append([nextIDtoAssign, word, count])
+        nextIDtoAssign += 1
+    logging.info("%d words in the old list got new counts; %d new words added" % (len(changed), len(added)))
+
+    def line(entry):
+        return "\t".join([str(entry[0]), entry[1].replace("\\","\\\\"), str(entry[2])]) + "\n"
+
+    output = open(".bookworm/texts/wordlist/newdelta.txt", "w")
+    for i in changed:
+        output.write(line(entries[i]))
+    for entry in added:
+        output.write(line(entry))
+    output.close()
+
+    output = open(".bookworm/texts/wordlist/newwordlist.txt", "w")
+    for entry in entries:
+        output.write(line(entry))
+    for entry in added:
+        output.write(line(entry))
+    output.close()
+
+    os.rename(".bookworm/texts/wordlist/newdelta.txt", ".bookworm/texts/wordlist/delta.txt")
+    os.rename(".bookworm/texts/wordlist/newwordlist.txt", ".bookworm/texts/wordlist/wordlist.txt")
+    return len(added)
+
+
+def countTokenBatch(rows):
+    """
+    Counts the words in a list of rows of space-delimited tokens.
+    """
+    counts = defaultdict(int)
+    for row in rows:
+        for item in row.split(" "):
+            counts[item.rstrip("\n")] += 1
+    return counts
+
+def _countingWorker(queue, directory, shards, maxMemoryStorage, counter):
+    """
+    One of the counting processes for `WordsTableCreateSharded`: counts
+    batches from the queue until it gets None, spilling into its own runs.
+    """
+    runs = shardedRuns(directory, shards)
+    keepThreshold = 2
+    wordcounts = dict()
+    for batch in iter(queue.get, None):
+        partial = counter(batch)
+        for (word, count) in partial.iteritems():
+            try:
+                wordcounts[word] += count
+            except KeyError:
+                wordcounts[word] = count
+        (wordcounts, keepThreshold) = spillToDisk(wordcounts, runs, keepThreshold, maxMemoryStorage)
+    exportToDisk(wordcounts,diskFile=runs,keepThreshold=float("inf"))
+
+def _shardTop(args):
+    (directory, n) = args
+    runs = sortedRuns(directory)
+    top = topWords(runs.merged(), n)
+    runs.clear()
+    return top
+
+def WordsTableCreateSharded(input, shards, fromText=False, batchSize=4*1024*1024,
+                            maxDictionaryLength=1000000, maxMemoryStorage=20000000, tmpdir=None,
+                            incremental=False, maxNewWords=None, counter=None, keepOldIds=True):
+    """
+    Count words across `shards` processes rather than in a single one.
+
+    Each worker counts whichever batches of input it takes next in its own
+    dictionary, of up to maxMemoryStorage/shards words, and spills runs split
+    by a hash of the word into one directory per shard. Since every word
+    lands in just one shard, the shards are then merged in parallel, and only
+    their top words are combined here.
+
+    The input is a token stream, as for `WordsTableCreate`, or with fromText,
+    bookworm-formatted text to be tokenized by the workers, or anything else
+    a picklable `counter` function turns into a dict of counts for a list of
+    rows. `incremental` is as for `WordsTableCreate`, and `keepOldIds` as
+    for `writeWordlist`.
+    """
+    import multiprocessing
+    import Queue
+    if counter is None:
+        counter = countTextBatch if fromText else countTokenBatch
+    if tmpdir is None:
+        tmpdir = ".bookworm/texts/wordlist/runs"
+    start_time = timeit.default_timer()
+
+    # Make the directories (and clear out any old runs) before the workers race to.
+    shardedRuns(tmpdir, shards, fresh=True)
+    queue = multiprocessing.Queue(2*shards)
+    workers = [multiprocessing.Process(target=_countingWorker,
+                                       args=(queue, tmpdir, shards, maxMemoryStorage // shards, counter))
+               for i in range(shards)]
+    for worker in workers:
+        worker.start()
+
+    def put(item):
+        while True:
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    for worker in workers:
+                        worker.terminate()
+                    raise RuntimeError("A word counting process failed")
+
+    for batch in _batches(input, batchSize):
+        put(batch)
+    for worker in workers:
+        put(None)
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError("A word counting process failed")
+    logging.info("Counted in %d shards in %d seconds" % (shards, int(timeit.default_timer() - start_time)))
+
+    directories = [os.path.join(tmpdir, "shard%d" % i) for i in range(shards)]
+    if incremental:
+        # Old words can be in any shard, so this merge runs here.
+        merged = itertools.chain(*[sortedRuns(directory).merged() for directory in directories])
+        mergeIntoWordlist(merged, maxDictionaryLength=maxDictionaryLength, maxNewWords=maxNewWords)
+        for directory in directories:
+            sortedRuns(directory).clear()
+        return
+    pool = multiprocessing.Pool(shards)
+    try:
+        tops = pool.map(_shardTop, [(directory, maxDictionaryLength) for directory in directories])
+    finally:
+        pool.close()
+        pool.join()
+    writeWordlist(topWords(itertools.chain(*tops), maxDictionaryLength), maxDictionaryLength=maxDictionaryLength,
+                  keepOldIds=keepOldIds)
+
+def countFeatureBatch(rows, sep=None):
+    """
+    Totals the counts for each token in a list of "textid token count"
+    feature-count lines, split on `sep` (by default, any whitespace).
+    """
+    counts = defaultdict(int)
+    for row in rows:
+        try:
+            (bookid, word, count) = row.split(sep)
+            counts[word] += int(count)
+        except ValueError:
+            logging.warning("Skipping a malformed feature count line starting with\n" + row[:50])
+    return counts
+
+def WordsTableCreateFromFeatures(input, shards=1, processes=1, sep=None, batchSize=4*1024*1024,
+                                 maxDictionaryLength=1000000, maxMemoryStorage=20000000, tmpdir=None,
+                                 incremental=False, maxNewWords=None):
+    """
+    Builds the wordlist from a feature-count file (lines of
+    "textid token count", as for `ingestFeatureCounts`) instead of text.
+
+    The counts are totalled with the same spilling and merging as for text,
+    so memory is bounded however many distinct tokens the file has: in this
+    process, in a pool of `processes`, or across `shards` as in
+    `WordsTableCreateSharded`.
+
+    That bound means the wordlist holds the top `maxDictionaryLength` tokens,
+    as it does for text, not every token in the file; the encoder skips the
+    rest. Unless `incremental`, any existing wordlist is replaced, as the
+    feature-count builder always did, rather than reused.
+    """
+    import functools
+    counter = countFeatureBatch if sep is None else functools.partial(countFeatureBatch, sep=sep)
+    if shards > 1:
+        WordsTableCreateSharded(input, shards, batchSize=batchSize, maxDictionaryLength=maxDictionaryLength,
+                                maxMemoryStorage=maxMemoryStorage, tmpdir=tmpdir,
+                                incremental=incremental, maxNewWords=maxNewWords, counter=counter, keepOldIds=False)
+    else:
+        WordsTableCreateFromText(input, processes=processes, batchSize=batchSize,
+                                 maxDictionaryLength=maxDictionaryLength, maxMemoryStorage=maxMemoryStorage,
+                                 tmpdir=tmpdir, incremental=incremental, maxNewWords=maxNewWords, counter=counter,
+                                 keepOldIds=False)
+
+def write_word_ids_from_feature_counts(featurefile, sep=None, **kwargs):
+    """
+    The wordids are counted directly from the unigrams file.
+
+    featurefile: an open unigrams.txt
+    sep: Delimiter. Defaults to None (whitespace), use this for tab- or
+            comma-delimiting.
+
+    Other arguments are passed to `WordsTableCreateFromFeatures`.
+    """
+    WordsTableCreateFromFeatures(featurefile, sep=sep, **kwargs)
+
+class heavyHitters(object):
+    """
+    A Misra-Gries summary: finds every word that makes up more than 1/(size+1)
+    of the input while holding at most about 2*size counts, however long the
+    tail of rare strings is.
+
+    Each stored count is a lower bound on the true one, and is short by at most
+    `self.decremented`.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = dict()
+        self.decremented = 0
+
+    def update(self, partial):
+        counts = self.counts
+        for (word, count) in partial.iteritems():
+            try:
+                counts[word] += count
+            except KeyError:
+                counts[word] = count
+        if len(counts) > 2*self.size:
+            self.prune()
+
+    def prune(self):
+        """
+        Subtract the (size+1)th largest count from everything, leaving at
+        most `size` words.
+        """
+        if len(self.counts) <= self.size:
+            return
+        threshold = heapq.nlargest(self.size + 1, self.counts.itervalues())[-1]
+        self.decremented += threshold
+        self.counts = dict((word, count - threshold) for (word, count) in self.counts.iteritems() if count > threshold)
+
+def WordsTableCreateApproximate(input, fromText=False, recount=None, sketchFactor=2,
+                                batchSize=4*1024*1024, maxDictionaryLength=1000000):
+    """
+    Builds the wordlist from a heavy-hitter summary of `sketchFactor` times
+    maxDictionaryLength words, rather than an exact count of every string.
+    Memory stays fixed however many distinct strings there are, and nothing
+    is spilled to disk.
+
+    Without `recount`, the wordlist gets the summary's estimated counts,
+    which can be low by the amount logged at the end. `recount` is a function
+    that returns the same input again: the candidates from the summary are
+    then counted exactly in a second pass, and the rest of the input ignored.
+    """
+    count = countTextBatch if fromText else countTokenBatch
+    sketch = heavyHitters(sketchFactor*maxDictionaryLength)
+    for batch in _batches(input, batchSize):
+        sketch.update(count(batch))
+    sketch.prune()
+    logging.info("%d candidate words; estimated counts are at most %d too low" % (len(sketch.counts), sketch.decremented))
 
+    if recount is None:
+        top = topWords(sketch.counts.iteritems(), maxDictionaryLength)
+    else:
+        exact = dict.fromkeys(sketch.counts, 0)
+        for batch in _batches(recount(), batchSize):
+            for (word, n) in count(batch).iteritems():
+                if word in exact:
+                    exact[word] += n
+        top = topWords(exact.iteritems(), maxDictionaryLength)
+    writeWordlist(top, maxDictionaryLength=maxDictionaryLength)
 
 
 if __name__=="__main__":
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+"""
+Times `tokenizer.counts` against the zip-of-slices, try/except version it
+replaced, on a generated document, and all three levels against
+`tokenizer.countLevels`, which counts them together in a single pass. Then
+times `ingestFeatureCounts.encodeFeatureCounts` against the line-at-a-time
+`encodePreTokenizedStream` on a generated feature-count file. Doesn't need
+MySQL; see bookwormDB/benchmark.md for the figures it produced.
+
+    python tests/bench_counts.py [--tokens 1000000] [--types 80000] [--repeats 3]
+                                 [--feature-rows 1000000]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from shutil import rmtree
+import bookwormDB.tokenizer
+
+
+def oldNgrams(tokens, n):
+    return zip(*[tokens[i:] for i in range(n)])
+
+
+def oldCounts(tokens, whichType):
+    count = dict()
+    for gram in oldNgrams(tokens, bookwormDB.tokenizer.NGRAM_LENGTHS[whichType]):
+        try:
+            count[gram] += 1
+        except KeyError:
+            count[gram] = 1
+    return count
+
+
+def newCounts(tokens, whichType):
+    t = bookwormDB.tokenizer.tokenizer("")
+    t.tokens = tokens
+    return t.counts(whichType)
+
+
+def slidingCounts(tokens, levels):
+    t = bookwormDB.tokenizer.tokenizer("")
+    t.tokens = tokens
+    return t.countLevels(levels)
+
+
+def document(nTokens, nTypes, seed=1):
+    """
+    `nTokens` words drawn from a zipfian vocabulary of `nTypes`.
+    """
+    rng = random.Random(seed)
+    vocabulary = ["w%d" % i for i in xrange(nTypes)]
+    # A log-uniform rank has the 1/rank frequencies of Zipf's law.
+    return [vocabulary[int(nTypes ** rng.random()) - 1] for i in xrange(nTokens)]
+
+
+def best(function, repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        result = function()
+        times.append(time.time() - t0)
+    return (min(times), result)
+
+
+def featureFile(path, nRows, nTypes, perText=200, seed=1):
+    """
+    Writes `nRows` "filename\ttoken\tcount" lines to `path`, `perText` distinct
+    zipfian tokens to a text, and sets up the wordlist and text ids for them
+    under .bookworm. Returns the number of texts.
+    """
+    rng = random.Random(seed)
+    nTexts = max(1, nRows // perText)
+    wordlist = open(".bookworm/texts/wordlist/wordlist.txt", "w")
+    # The rarest tenth of the tokens aren't in the wordlist, so some lines are dropped.
+    for i in xrange(nTypes * 9 // 10):
+        wordlist.write("%d\tw%d\t%d\n" % (i + 1, i, nTypes - i))
+    wordlist.close()
+    textids = open(".bookworm/texts/textids/1", "w")
+    output = open(path, "w")
+    for text in xrange(nTexts):
+        textids.write("%d\ttext%d\n" % (text + 1, text))
+        tokens = set()
+        while len(tokens) < perText:
+            tokens.add(int(nTypes ** rng.random()) - 1)
+        for token in tokens:
+            output.write("text%d\tw%d\t%d\n" % (text, token, rng.randint(1, 50)))
+    output.close()
+    textids.close()
+    bookwormDB.tokenizer.writeIDTable()
+    bookwormDB.tokenizer.writeDictionaryTable()
+    return nTexts
+
+
+def encodedLines():
+    """
+    Every line encoded so far, sorted, after which the encoded files are cleared.
+    """
+    lines = []
+    for folder in ["unigrams", "nwords"]:
+        directory = ".bookworm/texts/encoded/" + folder
+        for filename in os.listdir(directory):
+            lines.extend(folder + "\t" + line for line in open(os.path.join(directory, filename)))
+        rmtree(directory)
+        os.makedirs(directory)
+    return sorted(lines)
+
+
+def benchFeatureCounts(nRows, nTypes, repeats):
+    import bookwormDB.ingestFeatureCounts
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        for folder in ["wordlist", "textids", "encoded/unigrams", "encoded/nwords", "encoded/completed"]:
+            os.makedirs(".bookworm/texts/" + folder)
+        nTexts = featureFile("unigrams.txt", nRows, nTypes)
+        print "%d feature counts for %d texts; best of %d" % (nRows, nTexts, repeats)
+
+        def perLine():
+            bookwormDB.tokenizer.encodePreTokenizedStream(open("unigrams.txt"))
+            return encodedLines()
+
+        def chunked():
+            bookwormDB.ingestFeatureCounts.encodeFeatureCounts(open("unigrams.txt"))
+            return encodedLines()
+
+        (old, oldResult) = best(perLine, repeats)
+        (new, newResult) = best(chunked, repeats)
+        oldUnigrams = [line for line in oldResult if line.startswith("unigrams")]
+        newUnigrams = [line for line in newResult if line.startswith("unigrams")]
+        if oldUnigrams != newUnigrams:
+            raise AssertionError("the two feature-count encoders disagree")
+        print "    %-9s per line %.2fs  chunked %.2fs  (%.1fx)" % ("encode", old, new, old / new)
+    finally:
+        os.chdir(cwd)
+        rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--tokens", type=int, default=1000000)
+    parser.add_argument("--types", type=int, default=80000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--feature-rows", type=int, default=1000000)
+    args = parser.parse_args()
+    tokens = document(args.tokens, args.types)
+    print "%d tokens, %d types; best of %d" % (len(tokens), len(set(tokens)), args.repeats)
+    levels = ["unigrams", "bigrams", "trigrams"]
+    (totalOld, totalNew) = (0, 0)
+    for level in levels:
+        (old, oldResult) = best(lambda: oldCounts(tokens, level), args.repeats)
+        (new, newResult) = best(lambda: newCounts(tokens, level), args.repeats)
+        if oldResult != dict(newResult):
+            raise AssertionError("the two versions disagree on the %s" % level)
+        print "    %-9s old %.2fs  new %.2fs" % (level, old, new)
+        (totalOld, totalNew) = (totalOld + old, totalNew + new)
+    (sliding, slidingResult) = best(lambda: slidingCounts(tokens, levels), args.repeats)
+    for level in levels:
+        if dict(slidingResult[level]) != dict(newCounts(tokens, level)):
+            raise AssertionError("the single pass disagrees on the %s" % level)
+    print "    %-9s old %.2fs  new %.2fs  single pass %.2fs" % ("all", totalOld, totalNew, sliding)
+    benchFeatureCounts(args.feature_rows, args.types, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
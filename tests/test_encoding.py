@@ -0,0 +1,75 @@
+import unittest
+import bookwormDB
+import bookwormDB.tokenizer
+import logging
+import os
+import tempfile
+from shutil import rmtree
+
+"""
+Tests of encoding against a wordlist and text ids on disk. These don't need MySQL.
+"""
+
+class Bookworm_Encoding(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        for folder in ["wordlist", "textids", "encoded/unigrams", "encoded/completed"]:
+            os.makedirs(".bookworm/texts/" + folder)
+        wordlist = open(".bookworm/texts/wordlist/wordlist.txt", "w")
+        for (wordid, word) in enumerate(["the", "cat", "sat"]):
+            wordlist.write("%d\t%s\t10\n" % (wordid + 1, word))
+        wordlist.close()
+        textids = open(".bookworm/texts/textids/1", "w")
+        textids.write("10\ta\n11\tb\n12\tc\n")
+        textids.close()
+        bookwormDB.tokenizer.writeIDTable()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        rmtree(self.dir)
+
+    def nwords(self):
+        files = bookwormDB.tokenizer.encodedNwordsFiles()
+        self.assertTrue(files is not None)
+        totals = dict()
+        for filename in files:
+            for line in open(filename):
+                (bookid, n) = line.rstrip("\n").split("\t")
+                totals[int(bookid)] = totals.get(int(bookid), 0) + int(n)
+        return totals
+
+    def test_feature_counts_write_nwords(self):
+        logging.info("\n\nTESTING FEATURE COUNT ENCODING\n\n")
+        import bookwormDB.ingestFeatureCounts
+        features = open("unigrams.txt", "w")
+        features.write("a\tthe\t3\na\tcat\t2\na\tunknown\t7\nb\tsat\t4\nmissing\tthe\t1\nb\tthe\t1\n")
+        features.close()
+        bookwormDB.ingestFeatureCounts.encodeFeatureCounts("unigrams.txt", chunkRows=2)
+        counts = []
+        for filename in os.listdir(".bookworm/texts/encoded/unigrams"):
+            for line in open(".bookworm/texts/encoded/unigrams/" + filename):
+                counts.append(tuple(int(field) for field in line.split("\t")))
+        self.assertEqual(sorted(counts), [(10, 1, 3), (10, 2, 2), (11, 1, 1), (11, 3, 4)])
+        self.assertEqual(self.nwords(), {10: 5, 11: 5})
+
+    def test_text_encoding_writes_nwords(self):
+        logging.info("\n\nTESTING NWORDS WHILE ENCODING\n\n")
+        tokenBatch = bookwormDB.tokenizer.tokenBatches(levels=["unigrams"])
+        tokenBatch.attachDictionaryAndID()
+        tokenBatch.encodeRows(["a\tthe cat sat the dog", "c\tdog", "b\tcat"])
+        tokenBatch.flush()
+        self.assertEqual(self.nwords(), {10: 4, 11: 1, 12: 0})
+
+    def test_unmatched_count_files_fall_back(self):
+        os.makedirs(".bookworm/texts/encoded/nwords")
+        open(".bookworm/texts/encoded/nwords/x.txt", "w").close()
+        open(".bookworm/texts/encoded/unigrams/x.bin", "w").close()
+        os.makedirs(".bookworm/texts/encoded/unigrams/pipes")
+        self.assertEqual(bookwormDB.tokenizer.encodedNwordsFiles(), [".bookworm/texts/encoded/nwords/x.txt"])
+        open(".bookworm/texts/encoded/unigrams/y.txt", "w").close()
+        self.assertEqual(bookwormDB.tokenizer.encodedNwordsFiles(), None)
+
+if __name__=="__main__":
+    unittest.main()
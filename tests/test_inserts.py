@@ -0,0 +1,41 @@
+import unittest
+import bookwormDB
+import bookwormDB.CreateDatabase
+import logging
+
+"""
+Tests of the multi-row INSERT statements used where LOAD DATA LOCAL INFILE
+isn't allowed. These build the SQL without running it.
+"""
+
+class Bookworm_Inserts(unittest.TestCase):
+    columns = ["bookid", "wordid", "count"]
+
+    def statements(self, lines, batchRows=5000):
+        return list(bookwormDB.CreateDatabase.insert_statements_from_text(lines, "master_bookcounts", self.columns, batchRows))
+
+    def test_clean_batches(self):
+        logging.info("\n\nTESTING INSERT STATEMENTS\n\n")
+        self.assertEqual(self.statements(["1\t2\t3\n", "4\t5\t6\n", "7\t8\t9\n"], batchRows=2),
+                         [(2, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (1,2,3),(4,5,6)"),
+                          (1, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (7,8,9)")])
+
+    def test_empty_fields_are_skipped(self):
+        for bad in ["4\t\t6", "\t4\t6", "4\t5\t", "4\t5"]:
+            self.assertEqual(self.statements(["1\t2\t3", bad, "7\t8\t9"]),
+                             [(2, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (1,2,3),(7,8,9)")])
+
+    def test_other_malformed_lines_are_skipped(self):
+        self.assertEqual(self.statements(["1\t2\t3\n", "\n", "4\tfive\t6\n", "1\t2\t3\t4\n", "7\t8\t9"]),
+                         [(2, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (1,2,3),(7,8,9)")])
+        self.assertEqual(self.statements(["x\ty\tz\n"]), [])
+
+    def test_records(self):
+        import numpy as np
+        records = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]], dtype="<u4")
+        self.assertEqual(list(bookwormDB.CreateDatabase.insert_statements_from_records([records], "master_bookcounts", self.columns, 2)),
+                         [(2, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (1,2,3),(4,5,6)"),
+                          (1, "INSERT INTO master_bookcounts (bookid,wordid,count) VALUES (7,8,9)")])
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import bookwormDB
+import bookwormDB.lookupTables
+import logging
+import os
+import tempfile
+from shutil import rmtree
+
+"""
+Tests of the memory-mapped lookup tables. These don't need MySQL.
+"""
+
+class Bookworm_LookupTables(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        rmtree(self.dir)
+
+    def test_round_trip(self):
+        logging.info("\n\nTESTING LOOKUP TABLE ROUND TRIP\n\n")
+        items = dict(("word%d" % i, i * 7) for i in range(1000))
+        items[u"caf\xe9"] = 1001
+        items[""] = 1002
+        bookwormDB.lookupTables.writeTable("words.idx", items.iteritems())
+        table = bookwormDB.lookupTables.hashedTable("words.idx")
+        self.assertEqual(len(table), len(items))
+        for (key, value) in items.iteritems():
+            self.assertEqual(table[key], value)
+            self.assertTrue(key in table)
+        self.assertEqual(table[u"caf\xe9".encode("utf-8")], 1001)
+        self.assertEqual(sorted(table.key(i) for i in range(len(table))),
+                         sorted(key.encode("utf-8") for key in items))
+        self.assertEqual(table.getMany(["word3", u"caf\xe9", "missing"]), {"word3": 21, u"caf\xe9": 1001})
+
+    def test_missing_keys(self):
+        bookwormDB.lookupTables.writeTable("words.idx", [("the", 1), ("cat", 2)])
+        table = bookwormDB.lookupTables.hashedTable("words.idx")
+        self.assertRaises(KeyError, lambda: table["dog"])
+        self.assertFalse("dog" in table)
+        self.assertEqual(table.get("dog"), None)
+        self.assertEqual(table.get("dog", -1), -1)
+        self.assertEqual(table.getMany(["dog"]), {})
+
+    def test_empty_table(self):
+        bookwormDB.lookupTables.writeTable("empty.idx", [])
+        table = bookwormDB.lookupTables.hashedTable("empty.idx")
+        self.assertEqual(len(table), 0)
+        self.assertRaises(KeyError, lambda: table["the"])
+
+    def test_repeated_keys_keep_the_last_value(self):
+        bookwormDB.lookupTables.writeTable("words.idx", [("the", 1), ("cat", 2), ("the", 3)])
+        table = bookwormDB.lookupTables.hashedTable("words.idx")
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table["the"], 3)
+
+    def test_other_files_are_rejected(self):
+        open("words.txt", "w").write("the\t1\n" * 10)
+        self.assertRaises(IOError, bookwormDB.lookupTables.hashedTable, "words.txt")
+
+if __name__=="__main__":
+    unittest.main()
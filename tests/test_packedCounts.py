@@ -0,0 +1,84 @@
+import unittest
+import bookwormDB
+import bookwormDB.packedCounts
+import logging
+import os
+import tempfile
+from shutil import rmtree
+
+"""
+Tests of the packed binary count files. These don't need MySQL.
+"""
+
+class Bookworm_PackedCounts(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        # bookid, word1, word2, count
+        self.records = [[10, 1, 2, 3], [10, 2, 3, 1], [11, 4000000000, 5, 7]]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        rmtree(self.dir)
+
+    def write(self, path, records):
+        output = open(path, "ab")
+        bookwormDB.packedCounts.writeRecords(output, [field for record in records for field in record])
+        output.close()
+
+    def read(self, path, width, chunkRows=1000000):
+        return [record for chunk in bookwormDB.packedCounts.readRecords(path, width, chunkRows)
+                for record in chunk.tolist()]
+
+    def test_round_trip(self):
+        logging.info("\n\nTESTING PACKED COUNT ROUND TRIP\n\n")
+        width = bookwormDB.packedCounts.recordWidth("bigrams")
+        self.assertEqual(width, 4)
+        self.write("counts.bin", self.records)
+        self.assertEqual(self.read("counts.bin", width), self.records)
+        # Chunks split on whole records.
+        self.assertEqual(self.read("counts.bin", width, chunkRows=2), self.records)
+        self.assertEqual([len(chunk) for chunk in bookwormDB.packedCounts.readRecords("counts.bin", width, 2)], [2, 1])
+
+    def test_files_can_be_appended_to(self):
+        width = bookwormDB.packedCounts.recordWidth("bigrams")
+        self.write("counts.bin", self.records[:1])
+        self.write("counts.bin", self.records[1:])
+        self.assertEqual(self.read("counts.bin", width), self.records)
+
+    def test_partial_record_is_ignored(self):
+        width = bookwormDB.packedCounts.recordWidth("bigrams")
+        self.write("counts.bin", self.records)
+        self.write("counts.bin", [[12, 1]])
+        self.assertEqual(self.read("counts.bin", width), self.records)
+
+    def test_text_matches_the_records(self):
+        width = bookwormDB.packedCounts.recordWidth("bigrams")
+        self.write("counts.bin", self.records)
+        expected = "".join("\t".join(str(field) for field in record) + "\n" for record in self.records)
+        for chunk in bookwormDB.packedCounts.readRecords("counts.bin", width):
+            self.assertEqual(bookwormDB.packedCounts.formatRecords(chunk), expected)
+        output = open("counts.txt", "w")
+        bookwormDB.packedCounts.writeAsText("counts.bin", width, output, chunkRows=1)
+        output.close()
+        self.assertEqual(open("counts.txt").read(), expected)
+
+    def test_text_pipe(self):
+        width = bookwormDB.packedCounts.recordWidth("bigrams")
+        self.write("counts.bin", self.records)
+        with bookwormDB.packedCounts.textPipe("counts.bin", width, "pipes") as pipe:
+            text = open(pipe.path).read()
+        self.assertEqual(text.splitlines(), ["\t".join(str(field) for field in record) for record in self.records])
+        self.assertEqual(os.listdir("pipes"), [])
+        # Nothing ever reads this one.
+        with bookwormDB.packedCounts.textPipe("counts.bin", width, "pipes"):
+            pass
+        self.assertEqual(os.listdir("pipes"), [])
+
+    def test_empty_file(self):
+        open("counts.bin", "wb").close()
+        self.assertEqual(self.read("counts.bin", 3), [])
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import bookwormDB
+import bookwormDB.tokenizer
+import logging
+import os
+import tempfile
+from shutil import rmtree
+
+"""
+Tests of the tokenizer's on-disk formats. These don't need MySQL.
+"""
+
+class fixedCounts(object):
+    """
+    Stands in for a tokenizer with the given counts at every level.
+    """
+    def __init__(self, output):
+        self.output = output
+
+    def counts(self, level):
+        return self.output
+
+class Bookworm_CountShards(unittest.TestCase):
+    levels = ["unigrams", "bigrams", "trigrams"]
+
+    def encoded(self, tokens, level):
+        return dict((tuple(word.encode("utf-8") for word in gram), str(count))
+                    for (gram, count) in tokens.counts(level).iteritems())
+
+    def test_shard_row_round_trip(self):
+        logging.info("\n\nTESTING COUNT SHARD ROUND TRIP\n\n")
+        tokens = bookwormDB.tokenizer.tokenizer(u"The cat sat on the caf\xe9's cat.".encode("utf-8"))
+        row = bookwormDB.tokenizer.formatShardRow("a", tokens, self.levels)
+        self.assertTrue(isinstance(row, str))
+        self.assertEqual(len(row.split("\t")), 1 + len(self.levels))
+        shard = bookwormDB.tokenizer.shardCounts(row)
+        self.assertEqual(shard.filename, "a")
+        for level in self.levels:
+            self.assertEqual(shard.counts(level), self.encoded(tokens, level))
+        self.assertEqual(shard.counts("unigrams")[("cat",)], "2")
+
+    def test_empty_document(self):
+        tokens = bookwormDB.tokenizer.tokenizer("")
+        shard = bookwormDB.tokenizer.shardCounts(bookwormDB.tokenizer.formatShardRow("a", tokens, self.levels))
+        for level in self.levels:
+            self.assertEqual(shard.counts(level), {})
+
+    def test_unsplittable_words_are_dropped(self):
+        tokens = fixedCounts({(u"the", u"cat"): 2, (u"a\tb", u"cat"): 1, (u"a\nb", u"cat"): 1, (u"a b", u"cat"): 1})
+        row = bookwormDB.tokenizer.formatShardRow("a", tokens, ["bigrams"])
+        self.assertEqual(row, "a\tbigrams=the cat 2")
+        self.assertEqual(bookwormDB.tokenizer.shardCounts(row).counts("bigrams"), {("the", "cat"): "2"})
+
+    def test_only_requested_levels(self):
+        tokens = bookwormDB.tokenizer.tokenizer("the cat sat")
+        shard = bookwormDB.tokenizer.shardCounts(bookwormDB.tokenizer.formatShardRow("a", tokens, ["unigrams"]))
+        self.assertEqual(shard.counts("unigrams"), self.encoded(tokens, "unigrams"))
+        self.assertRaises(KeyError, shard.counts, "bigrams")
+
+class Bookworm_Counts(unittest.TestCase):
+    def test_one_pass_matches_each_level(self):
+        logging.info("\n\nTESTING SINGLE PASS NGRAM COUNTS\n\n")
+        for text in ["", "cat", "the cat", "the cat sat on the mat, and the cat sat."]:
+            tokens = bookwormDB.tokenizer.tokenizer(text)
+            for levels in [["unigrams"], ["bigrams"], ["unigrams", "bigrams"], ["trigrams", "unigrams"],
+                           ["unigrams", "bigrams", "trigrams"]]:
+                counted = bookwormDB.tokenizer.countLevels(tokens, levels)
+                self.assertEqual(sorted(counted), sorted(levels))
+                for level in levels:
+                    self.assertEqual(counted[level], tokens.counts(level))
+        counted = bookwormDB.tokenizer.countLevels(tokens, ["bigrams"])
+        self.assertRaises(KeyError, lambda: counted["bigrams"][("no", "such")])
+
+class Bookworm_CompletedIndex(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.folder = ".bookworm/texts/encoded/completed"
+        os.makedirs(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        rmtree(self.dir)
+
+    def complete(self, name, text):
+        output = open(self.folder + "/" + name, "a")
+        output.write(text)
+        output.close()
+
+    def test_recent_lines(self):
+        logging.info("\n\nTESTING THE COMPLETED INDEX\n\n")
+        self.complete("1", "a\nb\n")
+        self.complete("2", "c\nd")
+        seen = bookwormDB.tokenizer.completedIndex()
+        self.assertTrue("a" in seen and "b" in seen and "c" in seen)
+        # The last line may still be being written.
+        self.assertFalse("d" in seen)
+        self.assertFalse("e" in seen)
+        self.assertFalse(os.path.exists(seen.path))
+
+    def test_checkpoint(self):
+        self.complete("1", "a\nb\n")
+        self.complete("2", "c\nd")
+        bookwormDB.tokenizer.completedIndex().checkpoint()
+        self.assertTrue(os.path.exists(self.folder + ".idx"))
+        self.complete("2", "\ne\n")
+        self.complete("3", "f\n")
+        seen = bookwormDB.tokenizer.completedIndex()
+        self.assertEqual(len(seen.table), 3)
+        # Only what was written after the checkpoint is read from the files.
+        self.assertEqual(seen.recent, set(["d", "e", "f"]))
+        for name in "abcdef":
+            self.assertTrue(name in seen)
+        self.assertFalse("g" in seen)
+        seen.checkpoint()
+        self.assertEqual(seen.recent, set())
+        seen = bookwormDB.tokenizer.completedIndex()
+        self.assertEqual(len(seen.table), 6)
+        self.assertEqual(seen.recent, set())
+        for name in "abcdef":
+            self.assertTrue(name in seen)
+
+    def test_missing_manifest_rereads_everything(self):
+        self.complete("1", "a\n")
+        bookwormDB.tokenizer.completedIndex().checkpoint()
+        os.remove(self.folder + ".idx.manifest")
+        seen = bookwormDB.tokenizer.completedIndex()
+        self.assertTrue(seen.table is None)
+        self.assertEqual(seen.recent, set(["a"]))
+
+if __name__=="__main__":
+    unittest.main()
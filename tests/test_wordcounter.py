@@ -0,0 +1,145 @@
+import unittest
+import bookwormDB
+import bookwormDB.wordcounter
+import logging
+import os
+import random
+import tempfile
+from shutil import rmtree
+
+"""
+Tests of the approximate wordlist against the exact one. These don't need MySQL.
+"""
+
+class Bookworm_Wordlist(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs(".bookworm/texts/wordlist")
+        # A zipfian vocabulary with a long tail of one-off strings.
+        rng = random.Random(1)
+        self.rows = []
+        for i in range(500):
+            words = ["w%d" % int(rng.paretovariate(1.1)) for j in range(200)]
+            words += ["junk%d" % rng.getrandbits(40) for j in range(20)]
+            self.rows.append(" ".join(words) + "\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        rmtree(self.dir)
+
+    def wordlist(self):
+        output = []
+        for line in open(".bookworm/texts/wordlist/wordlist.txt"):
+            (wordid, word, count) = line.rstrip("\n").split("\t")
+            output.append((word, int(count)))
+        os.remove(".bookworm/texts/wordlist/wordlist.txt")
+        return output
+
+    def exact(self, n):
+        bookwormDB.wordcounter.WordsTableCreateSharded(iter(self.rows), shards=1, maxDictionaryLength=n)
+        return self.wordlist()
+
+    def test_approximate_with_recount_matches_exact(self):
+        logging.info("\n\nTESTING APPROXIMATE WORDLIST WITH RECOUNT\n\n")
+        exact = self.exact(100)
+        bookwormDB.wordcounter.WordsTableCreateApproximate(iter(self.rows), recount=lambda: iter(self.rows),
+                                                           maxDictionaryLength=100)
+        self.assertEqual(self.wordlist(), exact)
+
+    def test_approximate_counts_are_close(self):
+        logging.info("\n\nTESTING APPROXIMATE WORDLIST ESTIMATES\n\n")
+        exact = dict(self.exact(1000000))
+        bookwormDB.wordcounter.WordsTableCreateApproximate(iter(self.rows), maxDictionaryLength=100)
+        approximate = self.wordlist()
+        top = set(word for (word, count) in sorted(exact.items(), key=lambda pair: -pair[1])[:100])
+        found = set(word for (word, count) in approximate)
+        self.assertTrue(len(top & found) >= 95)
+        total = sum(exact.values())
+        for (word, count) in approximate:
+            self.assertTrue(count <= exact[word])
+            self.assertTrue(exact[word] - count <= total / 201)
+
+    def test_incremental_keeps_ids_and_adds_counts(self):
+        logging.info("\n\nTESTING INCREMENTAL WORDLIST\n\n")
+        (old, new) = (self.rows[:450], self.rows[450:])
+        bookwormDB.wordcounter.WordsTableCreateSharded(iter(old), shards=1)
+        ids = dict()
+        for line in open(".bookworm/texts/wordlist/wordlist.txt"):
+            (wordid, word, count) = line.rstrip("\n").split("\t")
+            ids[word] = int(wordid)
+        bookwormDB.wordcounter.WordsTableCreateSharded(iter(new), shards=1, incremental=True)
+        updated = dict()
+        for line in open(".bookworm/texts/wordlist/wordlist.txt"):
+            (wordid, word, count) = line.rstrip("\n").split("\t")
+            updated[word] = (int(wordid), int(count))
+        delta = set(line.split("\t")[1] for line in open(".bookworm/texts/wordlist/delta.txt"))
+        exact = dict(self.exact(1000000))
+        self.assertEqual(set(updated), set(exact))
+        for (word, (wordid, count)) in updated.iteritems():
+            self.assertEqual(count, exact[word])
+            if word in ids:
+                self.assertEqual(wordid, ids[word])
+            else:
+                self.assertTrue(wordid > max(ids.values()))
+                self.assertTrue(word in delta)
+        self.assertEqual(len(set(wordid for (wordid, count) in updated.values())), len(updated))
+
+    def test_runs_merge_into_totals(self):
+        logging.info("\n\nTESTING SORTED RUNS\n\n")
+        runs = bookwormDB.wordcounter.sortedRuns()
+        runs.writeRun([("b", 2), ("a", 1), ("c", 5)])
+        runs.writeRun([("c", 1), ("a", 3)])
+        runs.writeRun([])
+        self.assertEqual(list(runs.merged()), [("a", 4), ("b", 2), ("c", 6)])
+        runs.clear()
+        self.assertEqual(list(runs.merged()), [])
+
+    def test_sharded_runs_split_the_vocabulary(self):
+        runs = bookwormDB.wordcounter.shardedRuns(".bookworm/texts/wordlist/runs", 3)
+        runs.writeRun([("w%d" % i, i) for i in range(100)])
+        runs.writeRun([("w%d" % i, 1) for i in range(50)])
+        seen = dict()
+        for shard in runs.shards:
+            for (word, count) in shard.merged():
+                self.assertFalse(word in seen)
+                seen[word] = count
+        self.assertEqual(seen, dict(("w%d" % i, i + (i < 50)) for i in range(100)))
+
+    def test_spilling_matches_exact(self):
+        logging.info("\n\nTESTING SPILLED WORDLIST\n\n")
+        exact = self.exact(1000000)
+        bookwormDB.wordcounter.WordsTableCreateFromText(iter(self.rows), counter=bookwormDB.wordcounter.countTokenBatch,
+                                                        batchSize=1000, maxMemoryStorage=200)
+        self.assertEqual(sorted(self.wordlist()), sorted(exact))
+        bookwormDB.wordcounter.WordsTableCreateSharded(iter(self.rows), shards=2, batchSize=1000, maxMemoryStorage=400)
+        self.assertEqual(sorted(self.wordlist()), sorted(exact))
+
+    def test_leftover_runs_are_discarded(self):
+        logging.info("\n\nTESTING LEFTOVER RUNS\n\n")
+        exact = self.exact(1000000)
+        # As left by a count that died before merging.
+        bookwormDB.wordcounter.sortedRuns().writeRun([("w1", 1000000), ("stale", 5)])
+        bookwormDB.wordcounter.shardedRuns(".bookworm/texts/wordlist/runs", 2).writeRun([("w1", 1000000)])
+        bookwormDB.wordcounter.WordsTableCreateFromText(iter(self.rows), counter=bookwormDB.wordcounter.countTokenBatch)
+        self.assertEqual(sorted(self.wordlist()), sorted(exact))
+        bookwormDB.wordcounter.shardedRuns(".bookworm/texts/wordlist/runs", 2).writeRun([("w1", 1000000)])
+        bookwormDB.wordcounter.WordsTableCreateSharded(iter(self.rows), shards=2)
+        self.assertEqual(sorted(self.wordlist()), sorted(exact))
+
+    def test_feature_counts_replace_a_full_wordlist(self):
+        logging.info("\n\nTESTING FEATURE COUNT WORDLIST REBUILD\n\n")
+        features = ["a\tcat\t3\n", "a\tthe\t5\n", "b\tcat\t4\n", "b\tdog\t1\n"]
+        for shards in [1, 2]:
+            stale = open(".bookworm/texts/wordlist/wordlist.txt", "w")
+            for i in range(10):
+                stale.write("%d\tstale%d\t1\n" % (i + 1, i))
+            stale.close()
+            bookwormDB.wordcounter.write_word_ids_from_feature_counts(iter(features), shards=shards, maxDictionaryLength=2)
+            ids = [line.split("\t")[0] for line in open(".bookworm/texts/wordlist/wordlist.txt")]
+            self.assertEqual(ids, ["1", "2"])
+            self.assertEqual(self.wordlist(), [("cat", 7), ("the", 5)])
+
+if __name__=="__main__":
+    unittest.main()